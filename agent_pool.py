@@ -0,0 +1,78 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+POOL_MAX_BYTES = int(os.getenv("TUTOR_POOL_MAX_MB", "2048")) * 1024 * 1024
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class IndexPool:
+    # process-wide pool of loaded course tools (indexes and rerankers), keyed
+    # by (course_code, index_version) and evicted least recently used once the
+    # estimated size goes over max_bytes. sessions only build a light agent
+    # with their own chat memory on top of the shared, read-only tools.
+
+    def __init__(self, max_bytes=POOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def get(self, course_code, index_version, loader):
+        key = (course_code, index_version)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            # only one session loads a given course version, others wait on it
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        with load_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key][0]
+            tools, size = loader()
+            with self._lock:
+                self._loading.pop(key, None)
+                versions = [k[1] for k in self._entries if k[0] == course_code]
+                if any(version > index_version for version in versions):
+                    # a slow load of an older version finished after a newer
+                    # one was cached, it is served to its caller only
+                    return tools
+                # older versions of this course can never be asked for again
+                for version in versions:
+                    del self._entries[(course_code, version)]
+                self._entries[key] = (tools, size)
+                self._evict()
+            return tools
+
+    def invalidate(self, course_code):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == course_code]:
+                del self._entries[key]
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        # always keep the most recent entry, even if it is over budget alone
+        while total > self.max_bytes and len(self._entries) > 1:
+            key, (_, size) = self._entries.popitem(last=False)
+            print(f"evicting {key} from index pool")
+            total -= size
+
+
+course_pool = IndexPool()
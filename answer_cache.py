@@ -0,0 +1,104 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# questions that differ in one number or name still embed very closely, so a
+# hit also needs the same identifiers. raise the threshold if hits answer the
+# wrong question, lower it if rephrased questions keep missing.
+ANSWER_CACHE_THRESHOLD = float(os.getenv("TUTOR_ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("TUTOR_ANSWER_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("TUTOR_ANSWER_CACHE_MAX_ENTRIES", "512"))
+
+
+def question_identifiers(question):
+    # numbers and names: tokens with a digit ("HW3", "2"), all caps tokens
+    # ("CSE", "BFS") and capitalized words after the first one ("Dijkstra")
+    identifiers = set()
+    for i, token in enumerate(re.findall(r"[A-Za-z0-9]+", question)):
+        if any(c.isdigit() for c in token) or \
+                (len(token) > 1 and (token.isupper() or (i > 0 and token[0].isupper()))):
+            identifiers.add(token.lower())
+    return identifiers
+
+
+class SemanticAnswerCache:
+    # per-course cache of answered questions, looked up by cosine similarity
+    # of the question embedding. entries belong to one index_version of the
+    # course and are dropped as soon as a newer version is seen.
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._courses = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _course(self, course_code, index_version):
+        course = self._courses.get(course_code)
+        if course is None or course["index_version"] != index_version:
+            course = {"index_version": index_version, "entries": OrderedDict()}
+            self._courses[course_code] = course
+        return course
+
+    def _count(self, course_code, outcome):
+        stats = self._stats.setdefault(course_code, {"hits": 0, "misses": 0})
+        stats[outcome] += 1
+
+    def lookup(self, course_code, index_version, embedding, question):
+        identifiers = question_identifiers(question)
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        now = time.time()
+        with self._lock:
+            entries = self._course(course_code, index_version)["entries"]
+            for key in [k for k, e in entries.items() if now - e["created_at"] > self.ttl_seconds]:
+                del entries[key]
+            best_key, best_score = None, self.threshold
+            for key, entry in entries.items():
+                if entry["identifiers"] != identifiers:
+                    continue
+                score = float(np.dot(query, entry["embedding"]))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self._count(course_code, "misses")
+                return None
+            self._count(course_code, "hits")
+            entries.move_to_end(best_key)
+            return dict(entries[best_key], score=best_score)
+
+    def store(self, course_code, index_version, question, embedding, answer, sources):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            entries = self._course(course_code, index_version)["entries"]
+            entries[question] = {
+                "question": question,
+                "identifiers": question_identifiers(question),
+                "embedding": vector,
+                "answer": answer,
+                "sources": sources,
+                "created_at": time.time(),
+            }
+            entries.move_to_end(question)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, course_code):
+        with self._lock:
+            self._courses.pop(course_code, None)
+
+    def stats(self):
+        with self._lock:
+            return {course_code: dict(stats, entries=len(self._courses.get(course_code, {}).get("entries", {})))
+                    for course_code, stats in self._stats.items()}
+
+
+answer_cache = SemanticAnswerCache()
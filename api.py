@@ -1,10 +1,341 @@
 import os
+import json
+import time
+
+# cold start is measured from here, before the imports below
+process_start = time.perf_counter()
+
+import asyncio
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from pymongo import MongoClient
+
+import course_service
+from course_service import lookup_cached_answer, remember_answer
+from dao import find_course_config, get_index_version, add_message, get_latest_ingest_jobs, \
+    ensure_message_indexes, ensure_job_indexes
+from ingest import CATEGORIES, course_input_files
+from agent_pool import course_pool
+from answer_cache import answer_cache
+from metrics import metrics
+from warmup import start_warmup, report_cold_start, report_first_answer
+
+
+API_PORT = int(os.getenv("TUTOR_API_PORT", "8080"))
+# threads for blocking work: mongo, retrieval, rerank and the llm stream
+API_WORKERS = int(os.getenv("TUTOR_API_WORKERS", "64"))
+# requests allowed past the door at once, the rest wait up to the queue timeout
+API_MAX_INFLIGHT = int(os.getenv("TUTOR_API_MAX_INFLIGHT", "256"))
+API_COURSE_CONCURRENCY = int(os.getenv("TUTOR_API_COURSE_CONCURRENCY", "16"))
+API_QUEUE_TIMEOUT_SECONDS = float(os.getenv("TUTOR_API_QUEUE_TIMEOUT_SECONDS", "5"))
+API_MAX_SESSIONS = int(os.getenv("TUTOR_API_MAX_SESSIONS", "2048"))
+
+_db = None
+
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = MongoClient('mongodb://localhost:27017/').tutor
+    return _db
+
 
 def get_ai_response(user_input, course_code):
-    return f"Hello, I am your AI tutor of {course_code}. I am still learning. not implemented yet."
+    # one-off answer without a conversation, for scripts and the lms
+    course_config = find_course_config(get_db().courses, course_code)
+    if course_config is None:
+        return f"Course {course_code} does not exist."
+    agent = course_service.create_course_agent(course_code, course_config)
+    if agent is None:
+        return "The course files are still being processed, please ask again once they are ready."
+    return str(agent.chat(user_input))
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ChatSession:
+    def __init__(self, agent, index_version):
+        self.agent = agent
+        self.index_version = index_version
+        # one turn at a time per conversation, the agent memory is not thread safe
+        self.lock = asyncio.Lock()
+
+
+class TutorService:
+    # answers many conversations from one event loop. blocking calls run in a
+    # bounded thread pool, and requests are admitted through a global and a
+    # per-course semaphore so a burst queues briefly and is then turned away
+    # with a 503 instead of piling up threads. loaded course tools are shared
+    # through course_pool, each session only owns its agent and chat memory.
+
+    def __init__(self, db, max_workers=API_WORKERS, max_inflight=API_MAX_INFLIGHT,
+                 course_concurrency=API_COURSE_CONCURRENCY, max_sessions=API_MAX_SESSIONS):
+        self.courses_collection = db.courses
+        self.messages_collection = db.messages
+        self.jobs_collection = db.ingest_jobs
+        self.course_concurrency = course_concurrency
+        self.max_sessions = max_sessions
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tutor-api")
+        self._inflight = asyncio.Semaphore(max_inflight)
+        # a course's semaphore lives while a request holds or waits on it, so
+        # idle courses take no memory
+        self._course_limits = weakref.WeakValueDictionary()
+        self._sessions = OrderedDict()
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def run_to_end(self, fn, *args):
+        # aiohttp cancels the handler when the client goes away, but the
+        # executor thread keeps using the session's agent. the caller holds
+        # the session lock until that thread is done.
+        future = asyncio.ensure_future(self.run(fn, *args))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def _acquire(self, semaphore, name):
+        try:
+            await asyncio.wait_for(semaphore.acquire(), API_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            metrics.incr("api_rejected", limit=name)
+            raise Overloaded(name)
+
+    async def admit(self, course_code):
+        await self._acquire(self._inflight, "global")
+        course_limit = self._course_limits.get(course_code)
+        if course_limit is None:
+            course_limit = self._course_limits[course_code] = asyncio.Semaphore(self.course_concurrency)
+        try:
+            await self._acquire(course_limit, "course")
+        except Overloaded:
+            self._inflight.release()
+            raise
+        return course_limit
+
+    def release(self, course_limit):
+        course_limit.release()
+        self._inflight.release()
+
+    async def get_session(self, course_code, session_id):
+        course_config = await self.run(find_course_config, self.courses_collection, course_code)
+        if course_config is None:
+            return None
+        index_version = get_index_version(course_config)
+        key = (course_code, session_id)
+        session = self._sessions.get(key)
+        if session is None:
+            agent = await self.run(course_service.create_course_agent, course_code, course_config)
+            if agent is None:
+                return None
+            # another request of the session may have created it meanwhile
+            session = self._sessions.setdefault(key, ChatSession(agent, index_version))
+        elif session.index_version != index_version:
+            # a turn still running uses the agent, the swap waits for it
+            async with session.lock:
+                if session.index_version != index_version:
+                    # keep the conversation when the course files changed
+                    agent = await self.run_to_end(course_service.create_course_agent,
+                                                  course_code, course_config, session.agent.chat_history)
+                    if agent is None:
+                        return None
+                    session.agent, session.index_version = agent, index_version
+        # may have been evicted while this request waited
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def answer(self, session, course_code, user_input, on_token=None, cancelled=None):
+        # runs in the executor. returns (answer, sources, first token seconds)
+        start = time.perf_counter()
+        add_message(self.messages_collection, course_code, "user", user_input)
+        cached, embedding = lookup_cached_answer(session.agent, course_code, session.index_version, user_input)
+        if cached is not None:
+            metrics.observe("answer_cache_hit", time.perf_counter() - start, course=course_code)
+            if on_token is not None:
+                on_token(cached["answer"])
+            add_message(self.messages_collection, course_code, "assistant", cached["answer"])
+            return cached["answer"], cached["sources"], time.perf_counter() - start
+        resp = session.agent.stream_chat(user_input)
+        first_token_seconds = None
+        text = ""
+        for token in resp.response_gen:
+            if first_token_seconds is None:
+                first_token_seconds = time.perf_counter() - start
+            text += token
+            if on_token is not None:
+                on_token(token)
+            if cancelled is not None and cancelled():
+                break
+        total_seconds = time.perf_counter() - start
+        if first_token_seconds is None:
+            first_token_seconds = total_seconds
+        metrics.observe("first_token", first_token_seconds, course=course_code)
+        metrics.observe("agent_turn", total_seconds, course=course_code)
+        report_first_answer(first_token_seconds, course_code)
+        add_message(self.messages_collection, course_code, "assistant", text)
+        if cancelled is None or not cancelled():
+            remember_answer(course_code, session.index_version, user_input, embedding, text, resp)
+        return text, course_service.get_response_sources(resp), first_token_seconds
+
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda d: json.dumps(d, default=str))
+
+
+def overloaded_response(limit):
+    return json_response({"error": f"too many requests ({limit} limit), retry shortly"}, status=503)
+
+
+async def list_courses(request):
+    service = request.app["service"]
+    courses = await service.run(lambda: list(service.courses_collection.find(
+        {}, {"_id": 0, "course_code": 1, "course_description": 1})))
+    return json_response({"courses": courses})
+
+
+async def get_course(request):
+    service = request.app["service"]
+    course_code = request.match_info["course_code"]
+    course_config = await service.run(find_course_config, service.courses_collection, course_code)
+    if course_config is None:
+        return json_response({"error": f"course {course_code} does not exist"}, status=404)
+    course_config.pop("_id", None)
+    return json_response(course_config)
+
+
+async def get_ingestion(request):
+    service = request.app["service"]
+    course_code = request.match_info["course_code"]
+    course_config = await service.run(find_course_config, service.courses_collection, course_code)
+    if course_config is None:
+        return json_response({"error": f"course {course_code} does not exist"}, status=404)
+    latest = await service.run(get_latest_ingest_jobs, service.jobs_collection, course_code)
+    # ready once the newest job of every category with files has succeeded
+    ready = all(category in latest and latest[category]["status"] == "succeeded"
+                for category in CATEGORIES
+                if len(course_input_files(course_config, course_code, category)) != 0)
+    jobs = [latest[category] for category in CATEGORIES if category in latest]
+    for job in jobs:
+        job["id"] = str(job.pop("_id"))
+    return json_response({"course_code": course_code, "ready": ready, "jobs": jobs})
+
+
+async def chat(request):
+    service = request.app["service"]
+    course_code = request.match_info["course_code"]
+    try:
+        body = await request.json()
+    except ValueError:
+        return json_response({"error": "expected a json body"}, status=400)
+    user_input = (body.get("message") or "").strip()
+    if not user_input:
+        return json_response({"error": "message is required"}, status=400)
+    session_id = str(body.get("session_id") or "default")
+    try:
+        course_limit = await service.admit(course_code)
+    except Overloaded as e:
+        return overloaded_response(str(e))
+    try:
+        session = await service.get_session(course_code, session_id)
+        if session is None:
+            return json_response({"error": f"course {course_code} does not exist or is still being processed"},
+                                 status=409)
+        async with session.lock:
+            if body.get("stream"):
+                return await stream_chat(request, service, session, course_code, user_input)
+            answer, sources, first_token_seconds = await service.run_to_end(
+                service.answer, session, course_code, user_input)
+            return json_response({"answer": answer, "sources": sources,
+                                  "first_token_seconds": first_token_seconds})
+    finally:
+        service.release(course_limit)
+
+
+async def stream_chat(request, service, session, course_code, user_input):
+    # tokens are handed from the executor thread to the loop through a queue
+    # and sent as server-sent events: data: {"token": ...}, then a final
+    # data: {"done": true, "sources": [...]}
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    disconnected = False
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+
+    def on_token(token):
+        loop.call_soon_threadsafe(tokens.put_nowait, token)
+
+    future = asyncio.ensure_future(service.run(
+        service.answer, session, course_code, user_input, on_token, lambda: disconnected))
+    future.add_done_callback(lambda _: tokens.put_nowait(None))
+    try:
+        while True:
+            token = await tokens.get()
+            if token is None:
+                break
+            if disconnected:
+                continue
+            try:
+                await response.write(f"data: {json.dumps({'token': token})}\n\n".encode())
+            except ConnectionResetError:
+                # let the answer finish so the history stays consistent
+                disconnected = True
+    except asyncio.CancelledError:
+        # the handler was cancelled, the session lock is held until the
+        # answer has stopped
+        disconnected = True
+        await asyncio.wait([future])
+        raise
+    try:
+        _, sources, first_token_seconds = await future
+        event = {"done": True, "sources": sources, "first_token_seconds": first_token_seconds}
+    except Exception as e:
+        event = {"done": True, "error": str(e)}
+    if not disconnected:
+        await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await response.write_eof()
+    return response
+
+
+async def get_metrics(request):
+    return json_response({
+        "latency": metrics.summary(),
+        "counters": metrics.counters(),
+        "answer_cache": answer_cache.stats(),
+        "index_pool": {"bytes": course_pool.total_bytes(), "max_bytes": course_pool.max_bytes},
+    })
+
+
+async def init_service(app):
+    db = get_db()
+    ensure_message_indexes(db.messages)
+    ensure_job_indexes(db.ingest_jobs)
+    app["service"] = TutorService(db)
+    start_warmup(db.courses, db.messages)
+    report_cold_start(time.perf_counter() - process_start)
+
+
+def create_app():
+    app = web.Application()
+    app.on_startup.append(init_service)
+    app.add_routes([
+        web.get("/courses", list_courses),
+        web.get("/courses/{course_code}", get_course),
+        web.get("/courses/{course_code}/ingestion", get_ingestion),
+        web.post("/courses/{course_code}/chat", chat),
+        web.get("/metrics", get_metrics),
+    ])
+    return app
 
-def check_course_exists(course_path):
-    return os.path.exists(course_path)
 
-def get_all_courses(directory):
-    return [f for f in os.listdir(directory) if os.path.isdir(os.path.join(directory, f))]
+if __name__ == "__main__":
+    web.run_app(create_app(), port=API_PORT)
@@ -12,17 +12,48 @@
 # Another important reference is CHATGPT4.0, which help refine code.
 
 import os
-import shutil
+import time
+
+# cold start is measured from here, before the imports below
+script_start = time.perf_counter()
+
 import streamlit as st
 
-from api import check_course_exists, get_all_courses
-from model import get_agent
+import course_service
+from course_service import lookup_cached_answer, remember_answer, save_course_upload, drop_course_file, \
+    check_course_exists, get_all_courses
+from ingest import IngestWorker, STAGES
+from agent_pool import course_pool
+from answer_cache import answer_cache
+from metrics import metrics, span
 from pymongo import MongoClient
-from dao import get_course_config, update_course_config
+from dao import get_course_config, update_course_config, get_index_version, \
+    ensure_message_indexes, migrate_embedded_messages, get_messages, delete_messages, \
+    ensure_job_indexes, get_latest_ingest_jobs, cancel_ingest_job
+from dao import add_message as insert_message
+from warmup import start_warmup, report_cold_start, report_first_answer
+
+MESSAGE_PAGE_SIZE = 20
+FIRST_TOKEN_TARGET_SECONDS = 2.0
+INGEST_POLL_SECONDS = float(os.getenv("TUTOR_INGEST_POLL_SECONDS", "2"))
+
+
+@st.cache_resource
+def init_db():
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client.tutor
+    ensure_message_indexes(db.messages)
+    ensure_job_indexes(db.ingest_jobs)
+    migrate_embedded_messages(db.courses, db.messages)
+    metrics.start_file_exporter()
+    return db
 
-client = MongoClient('mongodb://localhost:27017/')
-db = client.tutor
+
+db = init_db()
 courses_collection = db.courses
+messages_collection = db.messages
+jobs_collection = db.ingest_jobs
+start_warmup(courses_collection, messages_collection)
 
 
 def add_custom_css():
@@ -37,79 +68,115 @@ def add_custom_css():
         """, unsafe_allow_html=True)
 
 
-def create_course_agent(course_code):
-    course_config = get_course_config(courses_collection, course_code)
-    file_categories = {
-        'slides': course_config['uploaded_files'].get('slides', []),
-        'assignments': course_config['uploaded_files'].get('assignments', []),
-        'syllabus': course_config['uploaded_files'].get('syllabus', [])
-    }
-    print(file_categories['slides'])
-    print(file_categories['assignments'])
-    print(file_categories['syllabus'])
-    system_prompt = course_config['system_prompt'] if 'system_prompt' in course_config else ''
-    agent = get_agent(
-        [os.path.join('document', course_code, file)
-         for file in file_categories['slides']],
-        [os.path.join('document', course_code, file)
-         for file in file_categories['assignments']],
-        [os.path.join('document', course_code, file)
-         for file in file_categories['syllabus']],
-        os.path.join('db', f'{course_code}_slides_index'),
-        os.path.join('db', f'{course_code}_assignments_index'),
-        os.path.join('db', f'{course_code}_syllabus_index'),
-        course_code=course_code,
-        course_title=course_config['course_description'],
-        instructor_prompt=system_prompt,
-    )
-    return agent
+def create_course_agent(course_code, course_config, chat_history=None):
+    return course_service.create_course_agent(course_code, course_config, chat_history,
+                                              use_pool=st.session_state['use_cache'])
 
-@st.cache_resource
-def create_course_agent_cached(course_code):
+
+def get_session_agent(course_code, spinner_text="Creating AI Tutor..."):
     course_config = get_course_config(courses_collection, course_code)
-    file_categories = {
-        'slides': course_config['uploaded_files'].get('slides', []),
-        'assignments': course_config['uploaded_files'].get('assignments', []),
-        'syllabus': course_config['uploaded_files'].get('syllabus', [])
-    }
-    print(file_categories['slides'])
-    print(file_categories['assignments'])
-    print(file_categories['syllabus'])
-    system_prompt = course_config['system_prompt'] if 'system_prompt' in course_config else ''
-    agent = get_agent(
-        [os.path.join('document', course_code, file)
-         for file in file_categories['slides']],
-        [os.path.join('document', course_code, file)
-         for file in file_categories['assignments']],
-        [os.path.join('document', course_code, file)
-         for file in file_categories['syllabus']],
-        os.path.join('db', f'{course_code}_slides_index'),
-        os.path.join('db', f'{course_code}_assignments_index'),
-        os.path.join('db', f'{course_code}_syllabus_index'),
-        course_code=course_code,
-        course_title=course_config['course_description'],
-        instructor_prompt=system_prompt,
-    )
-    return agent
-
-
-def get_ai_response(user_input, course_code):
-    if f'agent_{course_code}' not in st.session_state:
-        with st.spinner("Creating AI Tutor..."):
-            if st.session_state['use_cache']:
-                agent = create_course_agent_cached(course_code)
-            else:
-                agent = create_course_agent(course_code)
+    index_version = get_index_version(course_config)
+    if f'agent_{course_code}' not in st.session_state or \
+            st.session_state.get(f'agent_version_{course_code}') != index_version:
+        old_agent = st.session_state.get(f'agent_{course_code}')
+        # keep this session's conversation when the course files changed
+        chat_history = old_agent.chat_history if old_agent is not None else None
+        with st.spinner(spinner_text), span("agent_load", course=course_code):
+            agent = create_course_agent(course_code, course_config, chat_history)
         st.session_state[f'agent_{course_code}'] = agent
-    current_agent = st.session_state[f'agent_{course_code}']
-    with st.spinner("Thinking..."):
-        resp = current_agent.chat(user_input)
-    return resp
+        st.session_state[f'agent_version_{course_code}'] = index_version
+    return st.session_state[f'agent_{course_code}']
+
+
+def invalidate_course(course_code):
+    course_service.invalidate_course(courses_collection, course_code)
+
+
+@st.cache_resource
+def get_ingest_worker():
+    # one worker per process, a finished job publishes the new index version
+    worker = IngestWorker(courses_collection, jobs_collection, on_done=invalidate_course)
+    worker.start()
+    return worker
+
+
+def show_ingest_progress(course_code):
+    jobs = list(get_latest_ingest_jobs(jobs_collection, course_code).values())
+    for job in jobs:
+        if job["status"] == "failed":
+            # not retried on its own until the files change
+            st.error(f"Processing {job['category']} failed: {job['error']}")
+            if st.button("Retry", key=f"retry_{job['_id']}"):
+                get_ingest_worker().enqueue(course_code, job["category"])
+                st.rerun()
+    active = [job for job in jobs if job["status"] in ("queued", "running")]
+    if len(active) == 0:
+        return
+    st.subheader("Processing Course Files")
+    for job in active:
+        st.markdown(f"**{job['category'].title()}**: {job['status']} (attempt {max(job['attempts'], 1)})")
+        for item in job["progress"]:
+            st.progress(STAGES.index(item["stage"]) / (len(STAGES) - 1),
+                        text=f"{item['file']}: {item['stage']}")
+        if job["error"]:
+            st.caption(f"Last error: {job['error']}")
+        if st.button("Cancel", key=f"cancel_{job['_id']}"):
+            cancel_ingest_job(jobs_collection, job["_id"])
+            st.rerun()
+
+
+def ingest_active(course_code):
+    return any(job["status"] in ("queued", "running")
+               for job in get_latest_ingest_jobs(jobs_collection, course_code).values())
+
+
+def show_sources(sources):
+    if len(sources) == 0:
+        return
+    with st.expander("Sources"):
+        for source in sources:
+            st.markdown(f"**{source['file_name']}**")
+            st.text(source["text"])
+
+
+def stream_ai_response(user_input, course_code, placeholder):
+    current_agent = get_session_agent(course_code)
+    if current_agent is None:
+        placeholder.markdown("The course files are still being processed, please ask again once they are ready.")
+        return None, 0.0, 0.0, 0
+    placeholder.markdown("Thinking...")
+    start = time.perf_counter()
+    index_version = get_index_version(get_course_config(courses_collection, course_code))
+    cached, embedding = lookup_cached_answer(current_agent, course_code, index_version, user_input)
+    if cached is not None:
+        placeholder.markdown(cached["answer"])
+        show_sources(cached["sources"])
+        st.caption(f"Answered from cache (similarity {cached['score']:.3f})")
+        total_seconds = time.perf_counter() - start
+        metrics.observe("answer_cache_hit", total_seconds, course=course_code)
+        return cached["answer"], total_seconds, total_seconds, 0
+    resp = current_agent.stream_chat(user_input)
+    first_token_seconds = None
+    text = ""
+    for token in resp.response_gen:
+        if first_token_seconds is None:
+            first_token_seconds = time.perf_counter() - start
+        text += token
+        placeholder.markdown(text + "▌")
+    placeholder.markdown(text)
+    total_seconds = time.perf_counter() - start
+    remember_answer(course_code, index_version, user_input, embedding, text, resp)
+    if first_token_seconds is None:
+        first_token_seconds = total_seconds
+    print(f"{course_code}: first token {first_token_seconds:.2f}s, total {total_seconds:.2f}s")
+    metrics.observe("first_token", first_token_seconds, course=course_code)
+    metrics.observe("agent_turn", total_seconds, course=course_code)
+    report_first_answer(first_token_seconds, course_code)
+    return text, first_token_seconds, total_seconds, current_agent.last_tokens_saved
 
 
 def show_update_course_form(course_code):
     st.title(f"Update Course: {course_code}")
-    course_path = os.path.join('document', course_code)
     course_config = get_course_config(courses_collection, course_code)
     st.subheader("Existing Files")
     for category, files in course_config['uploaded_files'].items():
@@ -118,17 +185,11 @@ def show_update_course_form(course_code):
             col1, col2 = st.columns([0.8, 0.2])
             col1.markdown(file)
             if col2.button(f"Delete {file}", key=f"delete_{file}_{category}"):
-                course_config['uploaded_files'][category].remove(file)
-                # if the index exists, remove it
-                index_path = os.path.join(
-                    'db', f"{course_code}_{category}_index")
-                if os.path.exists(index_path):
-                    shutil.rmtree(index_path)
-                # remove agent 
-                if f'agent_{course_code}' in st.session_state:
-                    del st.session_state[f'agent_{course_code}']
+                drop_course_file(course_config, category, file)
                 update_course_config(courses_collection,
                                      course_code, course_config)
+                # the job drops this file's nodes from the index
+                get_ingest_worker().enqueue(course_code, category)
                 st.rerun()
     st.subheader("Upload New Files")
     new_slides = st.file_uploader("Upload Course Slides (PDF, PPT)",
@@ -146,20 +207,9 @@ def show_update_course_form(course_code):
 
     for category, files in new_files.items():
         if files is not None:
-            if len(files) > 0:
-                # remove the old index
-                index_path = os.path.join(
-                    'db', f"{course_code}_{category}_index")
-                if os.path.exists(index_path):
-                    shutil.rmtree(index_path)
-                # remove agent
-                if f'agent_{course_code}' in st.session_state:
-                    del st.session_state[f'agent_{course_code}']
             for file in files:
-                file_path = os.path.join(course_path, file.name)
                 if file.name not in course_config['uploaded_files'].get(category, []):
-                    with open(file_path, "wb") as f:
-                        f.write(file.getbuffer())
+                    save_course_upload(course_config, course_code, file)
                     if category not in course_config['uploaded_files']:
                         course_config['uploaded_files'][category] = []
                     course_config['uploaded_files'][category].append(file.name)
@@ -169,7 +219,12 @@ def show_update_course_form(course_code):
 
     if st.button(f"Update Course_{course_code}"):
         update_course_config(courses_collection, course_code, course_config)
+        # new files are added to the index incrementally in the background
+        for category, files in new_files.items():
+            if files:
+                get_ingest_worker().enqueue(course_code, category)
         st.success("Course updated successfully!")
+    show_ingest_progress(course_code)
 
 
 ###
@@ -205,25 +260,27 @@ def on_submit(action):
         }
 
         uploaded_files_info = {}
+        config_data = {
+            'course_code': course_code,
+            'course_description': course_description,
+            'uploaded_files': uploaded_files_info,
+            'system_prompt': course_system_prompt,
+            'file_hashes': {},
+        }
 
         for category, files in file_categories.items():
             if files is not None:
                 category_files = []
                 for file in files:
-                    file_path = os.path.join(save_path, file.name)
                     category_files.append(file.name)
-                    with open(file_path, "wb") as f:
-                        f.write(file.getbuffer())
+                    save_course_upload(config_data, course_code, file)
                 uploaded_files_info[category] = category_files
 
-        config_data = {
-            'course_code': course_code,
-            'course_description': course_description,
-            'uploaded_files': uploaded_files_info,
-            'system_prompt': course_system_prompt
-        }
         print(config_data)
         update_course_config(courses_collection, course_code, config_data)
+        for category, files in uploaded_files_info.items():
+            if len(files) > 0:
+                get_ingest_worker().enqueue(course_code, category)
         st.session_state['page'] = 'chat'
 
 
@@ -249,12 +306,34 @@ def show_input_form():
 
 def show_chat(course_code):
     st.title("AI Tutor Chat for " + course_code)
-    course_config = get_course_config(courses_collection, course_code)
-    historical_messages = course_config.get("messages", [])
-
+    show_ingest_progress(course_code)
+    historical_messages = load_chat_history(course_code)
+
+    if len(historical_messages) > 0 and \
+            st.session_state.get(f'has_older_messages_{course_code}', True):
+        if st.button("Load older messages"):
+            load_older_messages(course_code)
+            st.rerun()
     for message in historical_messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+    pending_input = st.session_state.pop(f'pending_input_{course_code}', None)
+    if pending_input:
+        with st.chat_message("assistant"):
+            ai_response, first_token_seconds, total_seconds, tokens_saved = stream_ai_response(
+                pending_input, course_code, st.empty())
+        # persisted once the whole answer has arrived
+        if ai_response is not None:
+            add_message(course_code, "assistant", ai_response)
+            st.session_state[f'last_latency_{course_code}'] = (first_token_seconds, total_seconds, tokens_saved)
+    if f'last_latency_{course_code}' in st.session_state:
+        first_token_seconds, total_seconds, tokens_saved = st.session_state[f'last_latency_{course_code}']
+        caption = f"First token in {first_token_seconds:.2f}s, full answer in {total_seconds:.2f}s"
+        if first_token_seconds > FIRST_TOKEN_TARGET_SECONDS:
+            caption += f" (over the {FIRST_TOKEN_TARGET_SECONDS:.0f}s target)"
+        if tokens_saved > 0:
+            caption += f", {tokens_saved} prompt tokens saved"
+        st.caption(caption)
     st.text_input("Your prompt", key='chat_input')
     st.button('Chat!', on_click=handle_chat_input)
 
@@ -271,18 +350,39 @@ def show_chat(course_code):
         st.rerun()
 
 
+def load_chat_history(course_code):
+    # only the latest page is read on the first render, later reruns fetch
+    # just the messages added after the newest one already loaded
+    key = f'messages_{course_code}'
+    if key not in st.session_state:
+        st.session_state[key] = get_messages(
+            messages_collection, course_code, limit=MESSAGE_PAGE_SIZE)
+        st.session_state[f'has_older_messages_{course_code}'] = \
+            len(st.session_state[key]) == MESSAGE_PAGE_SIZE
+    elif len(st.session_state[key]) > 0:
+        st.session_state[key] += get_messages(
+            messages_collection, course_code, limit=None, after=st.session_state[key][-1])
+    else:
+        st.session_state[key] = get_messages(
+            messages_collection, course_code, limit=MESSAGE_PAGE_SIZE)
+    return st.session_state[key]
+
+
+def load_older_messages(course_code):
+    key = f'messages_{course_code}'
+    older = get_messages(messages_collection, course_code,
+                         limit=MESSAGE_PAGE_SIZE, before=st.session_state[key][0])
+    st.session_state[key] = older + st.session_state[key]
+    st.session_state[f'has_older_messages_{course_code}'] = len(older) == MESSAGE_PAGE_SIZE
+
+
 def add_message(course_code, role, content):
-    course_config = get_course_config(courses_collection, course_code)
-    if "messages" not in course_config:
-        course_config["messages"] = []
-    course_config["messages"].append({"role": role, "content": content})
-    update_course_config(courses_collection, course_code, course_config)
+    insert_message(messages_collection, course_code, role, content)
 
 
 def delete_chat_history(course_code):
-    course_config = get_course_config(courses_collection, course_code)
-    course_config["messages"] = []
-    update_course_config(courses_collection, course_code, course_config)
+    delete_messages(messages_collection, course_code)
+    st.session_state.pop(f'messages_{course_code}', None)
 
 
 def handle_chat_input():
@@ -290,11 +390,29 @@ def handle_chat_input():
     if user_input:
         course_code = st.session_state['course_code']
         add_message(course_code, "user", user_input)
-        ai_response = get_ai_response(user_input, course_code).response
-        add_message(course_code, "assistant", ai_response)
+        # the answer is streamed by show_chat, below the history it belongs to
+        st.session_state[f'pending_input_{course_code}'] = user_input
         st.session_state['chat_input'] = ''
 
 
+def show_admin():
+    st.title("Metrics")
+    if st.button("Refresh metrics"):
+        st.rerun()
+    st.subheader("Latency (seconds)")
+    st.dataframe([dict(row, labels=", ".join(f"{k}={v}" for k, v in row["labels"].items()))
+                  for row in metrics.summary()], use_container_width=True)
+    st.subheader("Counters")
+    st.dataframe([dict(row, labels=", ".join(f"{k}={v}" for k, v in row["labels"].items()))
+                  for row in metrics.counters()], use_container_width=True)
+    st.subheader("Answer Cache")
+    st.dataframe([dict(stats, course=course_code)
+                  for course_code, stats in answer_cache.stats().items()], use_container_width=True)
+    st.subheader("Index Pool")
+    st.markdown(f"{course_pool.total_bytes() / 1024 / 1024:.1f} MB of "
+                f"{course_pool.max_bytes / 1024 / 1024:.0f} MB loaded")
+
+
 def main():
     add_custom_css()
     if 'page' not in st.session_state:
@@ -329,21 +447,28 @@ def main():
             if st.button(course):
                 st.session_state['course_code'] = course
                 st.session_state['page'] = 'chat'
+        st.markdown("---")
+        st.markdown("## Admin")
+        if st.button("Metrics"):
+            st.session_state['page'] = 'admin'
     course_code = st.session_state['course_code']
     if course_code:
-        if f'agent_{course_code}' not in st.session_state:
-            with st.spinner("Loading AI Tutor..."):
-                if st.session_state['use_cache']:
-                    agent = create_course_agent_cached(course_code)
-                else:
-                    agent = create_course_agent(course_code)
-            st.session_state[f'agent_{course_code}'] = agent
+        get_ingest_worker().ensure_indexed(
+            course_code, get_course_config(courses_collection, course_code))
+        get_session_agent(course_code, "Loading AI Tutor...")
     if st.session_state['page'] == 'input':
         show_input_form()
     elif st.session_state['page'] == 'chat':
         show_chat(st.session_state['course_code'])
     elif st.session_state['page'] == 'update':
         show_update_course_form(st.session_state['course_code'])
+    elif st.session_state['page'] == 'admin':
+        show_admin()
+    report_cold_start(time.perf_counter() - script_start)
+    if course_code and st.session_state['page'] in ('chat', 'update') and ingest_active(course_code):
+        # jobs run in the background, the page reruns until they are done
+        time.sleep(INGEST_POLL_SECONDS)
+        st.rerun()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,285 @@
+# Offline benchmark for ingestion, retrieval and answer latency.
+# Uses deterministic local stand-ins for the OpenAI LLM, the OpenAI embedding
+# model and the cross-encoder, so it runs without network access:
+#
+#   python benchmark.py --pages 10 100 1000 --output bench.json
+#
+# Two end to end numbers are measured: one query engine round trip (retrieve,
+# window replacement, rerank, synthesize), which is what each agent tool call
+# runs, and one turn of the course agent on its routed path (route, retrieve,
+# one streamed llm call, memory update). The function calling fallback of
+# the agent needs an OpenAI model, so the benchmark router always answers
+# directly.
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import resource
+import tempfile
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from llama_index.bridge.pydantic import Field
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import MockLLM
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.tools import QueryEngineTool, ToolMetadata
+
+from agent_pool import dir_size
+from blob_store import blob_store
+from context_budget import HISTORY_TOKEN_BUDGET, BudgetChatMemory
+from metrics import metrics, percentile
+from model import get_index, get_sentence_window_query_engine
+from questions import questions
+from router import RoutedAgent, ToolRouter
+
+
+WORDS_PER_PAGE = 300
+PAGES_PER_FILE = 20
+CONCURRENCY_LEVELS = [1, 8, 32]
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+class HashEmbedding(BaseEmbedding):
+    # bag of hashed words, normalized. similar texts get similar vectors, and
+    # the same text always gets the same vector.
+
+    dim: int = Field(default=256)
+    latency_ms: float = Field(default=0.0, description="Simulated round trip per batch.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in TOKEN_RE.findall(text.lower()):
+            vector[int(hashlib.md5(token.encode()).hexdigest(), 16) % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embeddings([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+
+class OverlapRerank(BaseNodePostprocessor):
+    # stands in for the cross-encoder: scores by shared words with the query
+
+    top_n: int = Field(default=2)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OverlapRerank"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        query_words = set(TOKEN_RE.findall(query_bundle.query_str.lower()))
+        for node in nodes:
+            words = set(TOKEN_RE.findall(node.node.get_content(metadata_mode=MetadataMode.EMBED).lower()))
+            node.score = len(query_words & words) / (len(query_words) or 1)
+        return sorted(nodes, key=lambda x: -x.score)[: self.top_n]
+
+
+class DirectOnlyAgent:
+    # stands in for the function calling agent under RoutedAgent. the
+    # benchmark router is always confident, so only the memory is used.
+
+    def __init__(self):
+        self.memory = BudgetChatMemory(token_limit=HISTORY_TOKEN_BUDGET)
+
+    @property
+    def chat_history(self):
+        return self.memory.get_all()
+
+    def reset(self):
+        self.memory.reset()
+
+
+def question_variants(count, seed=0):
+    rng = random.Random(seed)
+    prefixes = ["", "Can you explain: ", "Quick question. ", "For the homework, "]
+    suffixes = ["", " Thanks!", " Please give an example.", " I am confused about this."]
+    variants = list(questions)
+    while len(variants) < count:
+        words = rng.choice(questions).split()
+        # drop a few words so variants are near duplicates, not exact ones
+        words = [w for w in words if rng.random() > 0.1]
+        variants.append(rng.choice(prefixes) + " ".join(words) + rng.choice(suffixes))
+    return variants[:count]
+
+
+def generate_corpus(corpus_dir, pages, seed=0):
+    rng = random.Random(seed)
+    vocabulary = sorted(set(TOKEN_RE.findall(" ".join(questions).lower())))
+    vocabulary += ["lecture", "example", "definition", "theorem", "homework", "exam",
+                   "week", "reading", "section", "problem", "due", "midterm", "final"]
+    os.makedirs(corpus_dir, exist_ok=True)
+    input_files = []
+    for file_number in range(0, pages, PAGES_PER_FILE):
+        file_pages = min(PAGES_PER_FILE, pages - file_number)
+        sentences = []
+        for _ in range(file_pages * WORDS_PER_PAGE // 12):
+            sentence = " ".join(rng.choice(vocabulary) for _ in range(12))
+            sentences.append(sentence.capitalize() + ".")
+        input_file = os.path.join(corpus_dir, f"lecture_{file_number // PAGES_PER_FILE:04d}.txt")
+        with open(input_file, "w") as f:
+            f.write(" ".join(sentences))
+        input_files.append(input_file)
+    return input_files
+
+
+def peak_rss_bytes():
+    # peak of the whole process, which is why every run gets its own process
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50": percentile(samples, 0.50),
+        "p95": percentile(samples, 0.95),
+        "max": samples[-1] if samples else 0.0,
+    }
+
+
+def agent_asker(query_engine, embed_model, llm):
+    # every question is the first turn of a new session, sessions share the
+    # tools and the router like the sessions of one pooled course
+    tools = [QueryEngineTool(
+        query_engine=query_engine,
+        metadata=ToolMetadata(name="lecture_question_query_engine",
+                              description="Answers questions about the course lectures."))]
+    router = ToolRouter(tools, embed_model, min_score=-1.0)
+
+    def ask(query):
+        agent = RoutedAgent(DirectOnlyAgent(), tools, router, llm,
+                            "You are a teaching assistant.", course_code="benchmark")
+        agent.chat(query)
+    return ask
+
+
+def run_queries(ask, queries, concurrency):
+    def timed_query(query):
+        start = time.perf_counter()
+        ask(query)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(timed_query, queries))
+    wall = time.perf_counter() - start
+    return dict(latency_summary(samples), concurrency=concurrency,
+                queries_per_second=len(queries) / wall if wall else 0.0)
+
+
+def run_benchmark(pages, work_dir, queries_per_level, parse_workers, embed_latency_ms, seed):
+    corpus_dir = os.path.join(work_dir, f"corpus_{pages}")
+    save_dir = os.path.join(work_dir, f"index_{pages}")
+    shutil.rmtree(save_dir, ignore_errors=True)
+    input_files = generate_corpus(corpus_dir, pages, seed)
+    llm = MockLLM(max_tokens=64)
+    embed_model = HashEmbedding(latency_ms=embed_latency_ms)
+
+    start = time.perf_counter()
+    get_index(input_files, save_dir, parse_workers=parse_workers, llm=llm, embed_model=embed_model)
+    ingest_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = get_index(input_files, save_dir, load_only=True, llm=llm, embed_model=embed_model)
+    cold_load_seconds = time.perf_counter() - start
+
+    query_engine = get_sentence_window_query_engine(index, similarity_top_k=6, rerank=OverlapRerank(top_n=2))
+    ask_agent = agent_asker(query_engine, embed_model, llm)
+    queries = question_variants(queries_per_level, seed)
+    return {
+        "pages": pages,
+        "files": len(input_files),
+        "ingest_seconds": ingest_seconds,
+        "ingest_pages_per_second": pages / ingest_seconds if ingest_seconds else 0.0,
+        "index_size_bytes": dir_size(save_dir),
+        "cold_load_seconds": cold_load_seconds,
+        "queries": [run_queries(query_engine.query, queries, concurrency)
+                    for concurrency in CONCURRENCY_LEVELS],
+        "agent_turns": [run_queries(ask_agent, queries, concurrency)
+                        for concurrency in CONCURRENCY_LEVELS],
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def run_isolated(pages, work_dir, blob_root, queries_per_level, parse_workers, embed_latency_ms, seed):
+    # runs in a fresh process, so peak rss and stage latencies are this
+    # corpus size's alone and not left over from a larger earlier run
+    blob_store.root = blob_root
+    run = run_benchmark(pages, work_dir, queries_per_level, parse_workers, embed_latency_ms, seed)
+    run["stages"] = metrics.summary()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline tutor benchmark")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000],
+                        help="corpus sizes to benchmark, 10 to 10000 pages")
+    parser.add_argument("--queries", type=int, default=64,
+                        help="queries per concurrency level")
+    parser.add_argument("--parse-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0,
+                        help="simulated embedding round trip per batch")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None,
+                        help="where corpora and indexes are written, a temp dir by default")
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="tutor_bench_")
+    # parse and split caches of earlier runs would hide the ingest cost
+    blob_store.root = os.path.join(work_dir, f"blobs_{int(time.time())}")
+    results = {
+        "started_at": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "args": vars(args),
+        "runs": [],
+    }
+    for pages in args.pages:
+        print(f"benchmarking {pages} pages")
+        blob_root = os.path.join(blob_store.root, f"pages_{pages}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results["runs"].append(executor.submit(
+                run_isolated, pages, work_dir, blob_root, args.queries, args.parse_workers,
+                args.embed_latency_ms, args.seed).result())
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"wrote {args.output}")
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
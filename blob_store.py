@@ -0,0 +1,113 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+
+
+BLOB_DIR = os.getenv("TUTOR_BLOB_DIR", os.path.join("db", "blobs"))
+BLOB_CHUNK_SIZE = int(os.getenv("TUTOR_BLOB_CHUNK_SIZE", str(1 << 20)))
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class BlobStore:
+    # uploaded files stored once, named by the sha256 of their content. course
+    # documents under document/{course_code}/ are hardlinks to the blobs, so
+    # the same pdf uploaded to two courses or under two names takes the disk
+    # space once. parsed text and sentence splits are cached by hash too, so
+    # a file that was ingested anywhere is never parsed or split again.
+
+    def __init__(self, root=BLOB_DIR, chunk_size=BLOB_CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _cache_path(self, kind, digest):
+        return os.path.join(self.root, kind, digest[:2], f"{digest}.json")
+
+    def _tmp_path(self):
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        return os.path.join(tmp_dir, uuid.uuid4().hex)
+
+    def put_stream(self, stream):
+        # hashes while writing in chunks, the upload is never copied whole
+        h = hashlib.sha256()
+        tmp_path = self._tmp_path()
+        with open(tmp_path, "wb") as f:
+            for chunk in iter(lambda: stream.read(self.chunk_size), b""):
+                h.update(chunk)
+                f.write(chunk)
+        digest = h.hexdigest()
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        return digest
+
+    def link(self, digest, dest_path):
+        # replaces dest_path atomically, readers never see a partial file
+        os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+        tmp_path = dest_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(self.blob_path(digest), tmp_path)
+        except OSError:
+            # no hardlinks across devices or on some filesystems
+            shutil.copyfile(self.blob_path(digest), tmp_path)
+        os.replace(tmp_path, dest_path)
+
+    def save_upload(self, stream, dest_path):
+        stream.seek(0)
+        digest = self.put_stream(stream)
+        self.link(digest, dest_path)
+        return digest
+
+    def _get_cached(self, kind, digest):
+        path = self._cache_path(kind, digest)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _put_cached(self, kind, digest, value):
+        path = self._cache_path(kind, digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = self._tmp_path()
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def get_parsed(self, digest):
+        return self._get_cached("parsed", digest)
+
+    def put_parsed(self, digest, text):
+        self._put_cached("parsed", digest, text)
+
+    def cached_splitter(self, splitter):
+        # sentence splits keyed by the hash of the parsed text
+        def split(text):
+            digest = text_digest(text)
+            sentences = self._get_cached("sentences", digest)
+            if sentences is None:
+                sentences = splitter(text)
+                self._put_cached("sentences", digest, sentences)
+            return sentences
+        return split
+
+
+blob_store = BlobStore()
@@ -0,0 +1,238 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, List, Optional
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.llms import ChatMessage, MessageRole
+from llama_index.memory import ChatMemoryBuffer
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle
+
+from llm_metrics import count_tokens
+from metrics import metrics
+from sentence_window import WINDOW_START_KEY, WINDOW_END_KEY
+
+
+# retrieved text sent to the llm in one turn, summed over every tool call
+CONTEXT_TOKEN_BUDGET = int(os.getenv("TUTOR_CONTEXT_TOKEN_BUDGET", "2000"))
+# chat history sent with each llm call, older turns are summarized
+HISTORY_TOKEN_BUDGET = int(os.getenv("TUTOR_HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("TUTOR_HISTORY_SUMMARY_TOKENS", "200"))
+
+_local = threading.local()
+
+
+class TurnBudget:
+    # what one agent turn has sent to the llm so far: the sentences, so other
+    # tools do not send them again, and the context tokens left to spend
+
+    def __init__(self, course_code="", context_tokens=CONTEXT_TOKEN_BUDGET):
+        self.course_code = course_code
+        self.remaining = context_tokens
+        self.saved = 0
+        # the agent reads its memory on every llm call of the turn, the
+        # history it leaves out is counted on the first read only
+        self.history_recorded = False
+        self.lock = threading.Lock()
+        self._seen = set()
+
+    def seen(self, sentence):
+        return sentence_key(sentence) in self._seen
+
+    def spend(self, sentences, tokens):
+        self._seen.update(sentence_key(s) for s in sentences)
+        self.remaining -= tokens
+
+    @contextmanager
+    def activate(self):
+        # tools called from this thread share the budget
+        previous = getattr(_local, "turn", None)
+        _local.turn = self
+        try:
+            yield self
+        finally:
+            _local.turn = previous
+
+
+def current_turn():
+    return getattr(_local, "turn", None)
+
+
+def record_saved(part, tokens, course_code=""):
+    if tokens <= 0:
+        return
+    metrics.incr("prompt_tokens_saved", tokens, part=part, course=course_code)
+    turn = current_turn()
+    if turn is not None:
+        with turn.lock:
+            turn.saved += tokens
+
+
+def sentence_key(sentence):
+    return " ".join(sentence.lower().split())
+
+
+def node_sentences(node, sentence_buffer):
+    metadata = node.metadata
+    if sentence_buffer is not None and WINDOW_START_KEY in metadata:
+        try:
+            return sentence_buffer.sentences(
+                node.ref_doc_id, metadata[WINDOW_START_KEY], metadata[WINDOW_END_KEY])
+        except KeyError:
+            pass
+    # nodes with their full window in the metadata are kept or dropped whole
+    return [node.get_content()]
+
+
+def merge_windows(nodes, sentence_buffer):
+    # windows of neighbouring sentences overlap, retrieving two of them would
+    # send the shared sentences twice. overlapping windows of one document
+    # become one window over both ranges, at the best of their scores.
+    merged = []
+    for n in nodes:
+        metadata = n.node.metadata
+        target = None
+        if sentence_buffer is not None and WINDOW_START_KEY in metadata:
+            for m in merged:
+                other = m.node.metadata
+                if m.node.ref_doc_id == n.node.ref_doc_id and WINDOW_START_KEY in other and \
+                        metadata[WINDOW_START_KEY] <= other[WINDOW_END_KEY] and \
+                        other[WINDOW_START_KEY] <= metadata[WINDOW_END_KEY]:
+                    target = m
+                    break
+        if target is None:
+            merged.append(n)
+            continue
+        other = target.node.metadata
+        other[WINDOW_START_KEY] = min(other[WINDOW_START_KEY], metadata[WINDOW_START_KEY])
+        other[WINDOW_END_KEY] = max(other[WINDOW_END_KEY], metadata[WINDOW_END_KEY])
+        target.score = max(target.score or 0.0, n.score or 0.0)
+        target.node.set_content(sentence_buffer.window(
+            target.node.ref_doc_id, other[WINDOW_START_KEY], other[WINDOW_END_KEY]))
+    return merged
+
+
+def compress_nodes(nodes, sentence_buffer, turn):
+    # best nodes first: drop sentences the turn already sent, then keep whole
+    # sentences while the turn's context budget lasts
+    before = sum(count_tokens(n.node.get_content()) for n in nodes)
+    kept = []
+    with turn.lock:
+        for n in merge_windows(nodes, sentence_buffer):
+            sentences = node_sentences(n.node, sentence_buffer)
+            fresh = [s for s in sentences if not turn.seen(s)]
+            tokens = count_tokens(" ".join(fresh))
+            if tokens > turn.remaining:
+                fitting, tokens = [], 0
+                for sentence in fresh:
+                    sentence_tokens = count_tokens(sentence)
+                    if tokens + sentence_tokens > turn.remaining:
+                        break
+                    fitting.append(sentence)
+                    tokens += sentence_tokens
+                fresh = fitting
+            if len(fresh) == 0:
+                continue
+            if len(fresh) != len(sentences):
+                n.node.set_content(" ".join(fresh))
+            turn.spend(fresh, tokens)
+            kept.append(n)
+    after = sum(count_tokens(n.node.get_content()) for n in kept)
+    record_saved("context", before - after, turn.course_code)
+    return kept
+
+
+class ContextBudgetPostProcessor(BaseNodePostprocessor):
+    # runs after rerank. inside an agent turn the budget is shared by every
+    # tool call of the turn, otherwise each query gets a budget of its own.
+
+    context_tokens: int = Field(default=CONTEXT_TOKEN_BUDGET)
+    _sentence_buffer: Any = PrivateAttr()
+    _course_code: str = PrivateAttr()
+
+    def __init__(self, sentence_buffer=None, course_code="", **kwargs):
+        super().__init__(**kwargs)
+        self._sentence_buffer = sentence_buffer
+        self._course_code = course_code
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextBudgetPostProcessor"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        turn = current_turn() or TurnBudget(self._course_code, self.context_tokens)
+        return compress_nodes(nodes, self._sentence_buffer, turn)
+
+
+def is_tool_message(message):
+    if message.role in (MessageRole.FUNCTION, MessageRole.TOOL):
+        return True
+    return message.role == MessageRole.ASSISTANT and (
+        "function_call" in message.additional_kwargs or "tool_calls" in message.additional_kwargs)
+
+
+class BudgetChatMemory(ChatMemoryBuffer):
+    # chat memory that keeps each llm call within token_limit. tool calls and
+    # tool outputs of finished turns are dropped, they were only needed to
+    # write that turn's answer. the newest turns that fit are sent as they
+    # are, and the older ones are summarized as the questions the student
+    # asked, so the model still knows what was covered.
+
+    course_code: str = ""
+    summary_token_limit: int = Field(default=HISTORY_SUMMARY_TOKENS)
+
+    def get(self, initial_token_count: int = 0, **kwargs: Any) -> List[ChatMessage]:
+        history = self.chat_history
+        # a turn still running (user message, tool calls) is always sent whole
+        start = len(history)
+        if len(history) != 0 and (history[-1].role != MessageRole.ASSISTANT or is_tool_message(history[-1])):
+            user_messages = [i for i, m in enumerate(history) if m.role == MessageRole.USER]
+            start = user_messages[-1] if user_messages else 0
+        current = history[start:]
+        older = [m for m in history[:start] if not is_tool_message(m)]
+        budget = self.token_limit - initial_token_count - \
+            sum(count_tokens(str(m.content or "")) for m in current)
+        kept = []
+        for message in reversed(older):
+            tokens = count_tokens(str(message.content or ""))
+            if tokens > budget:
+                break
+            kept.insert(0, message)
+            budget -= tokens
+        while len(kept) != 0 and kept[0].role != MessageRole.USER:
+            kept.pop(0)
+        messages = kept + current
+        dropped = older[:len(older) - len(kept)]
+        if len(dropped) != 0:
+            summary = self._summarize(dropped)
+            if summary is not None:
+                messages = [summary] + messages
+        turn = current_turn()
+        if turn is None or not turn.history_recorded:
+            record_saved("history",
+                         sum(count_tokens(str(m.content or "")) for m in history) -
+                         sum(count_tokens(str(m.content or "")) for m in messages),
+                         self.course_code)
+            if turn is not None:
+                turn.history_recorded = True
+        return messages
+
+    def _summarize(self, messages):
+        # the most recent questions that fit, no llm call needed
+        questions = [str(m.content) for m in messages if m.role == MessageRole.USER and m.content]
+        prefix = "Earlier in this conversation the student asked: "
+        summary, tokens = [], count_tokens(prefix)
+        for question in reversed(questions):
+            question_tokens = count_tokens(question) + 1
+            if tokens + question_tokens > self.summary_token_limit:
+                break
+            summary.insert(0, question)
+            tokens += question_tokens
+        if len(summary) == 0:
+            return None
+        return ChatMessage(role=MessageRole.SYSTEM, content=prefix + " | ".join(summary))
@@ -0,0 +1,132 @@
+import os
+
+from agent_pool import course_pool, dir_size
+from blob_store import blob_store
+from answer_cache import answer_cache
+from dao import get_index_version, bump_index_version
+from ingest import CATEGORIES, course_index_dir
+
+
+# course level helpers shared by the streamlit app and the http api. model,
+# and with it llama_index, is only imported by the helpers that load a course,
+# so pages that never answer a question start without it.
+
+
+def check_course_exists(course_path):
+    return os.path.exists(course_path)
+
+
+def get_all_courses(directory):
+    return [f for f in os.listdir(directory) if os.path.isdir(os.path.join(directory, f))]
+
+
+def course_index_dirs(course_code):
+    return [course_index_dir(course_code, category) for category in CATEGORIES]
+
+
+def load_course_tools(course_code, course_config):
+    from model import get_tools, get_router, live_index_dir
+    from unified_index import INDEX_LAYOUT, unified_index
+
+    file_categories = {
+        'slides': course_config['uploaded_files'].get('slides', []),
+        'assignments': course_config['uploaded_files'].get('assignments', []),
+        'syllabus': course_config['uploaded_files'].get('syllabus', [])
+    }
+    print(file_categories['slides'])
+    print(file_categories['assignments'])
+    print(file_categories['syllabus'])
+    index_dirs = course_index_dirs(course_code)
+    tools = get_tools(
+        [os.path.join('document', course_code, file)
+         for file in file_categories['slides']],
+        [os.path.join('document', course_code, file)
+         for file in file_categories['assignments']],
+        [os.path.join('document', course_code, file)
+         for file in file_categories['syllabus']],
+        *index_dirs,
+        course_code=course_code,
+        course_title=course_config['course_description'],
+        # indexes are built by the ingest worker, never while answering
+        load_only=True,
+        unified=unified_index if INDEX_LAYOUT == "unified" else None,
+    )
+    if INDEX_LAYOUT == "unified":
+        # the unified index is loaded once for all courses, only directories
+        # not migrated yet are this course's own
+        index_dirs = [index_dir for category, index_dir in zip(CATEGORIES, index_dirs)
+                      if not unified_index.ready(course_code, category)]
+    # the router is shared with the tools, so what it learns from one
+    # session's questions helps every session of the course
+    router = get_router(tools, course_config.get('router_exemplars'))
+    return (tools, router), sum(dir_size(live_index_dir(index_dir)) for index_dir in index_dirs)
+
+
+def create_course_agent(course_code, course_config, chat_history=None, use_pool=True):
+    from model import build_agent
+
+    if use_pool:
+        tools, router = course_pool.get(course_code, get_index_version(course_config),
+                                        lambda: load_course_tools(course_code, course_config))
+    else:
+        (tools, router), _ = load_course_tools(course_code, course_config)
+    system_prompt = course_config['system_prompt'] if 'system_prompt' in course_config else ''
+    return build_agent(
+        tools,
+        course_code=course_code,
+        course_title=course_config['course_description'],
+        instructor_prompt=system_prompt,
+        chat_history=chat_history,
+        router=router,
+    )
+
+
+def save_course_upload(course_config, course_code, uploaded_file):
+    # the upload goes into the blob store once, the course document is a
+    # link to it and the course config keeps the name -> hash reference
+    digest = blob_store.save_upload(
+        uploaded_file, os.path.join('document', course_code, uploaded_file.name))
+    course_config.setdefault('file_hashes', {})[uploaded_file.name] = digest
+    return digest
+
+
+def drop_course_file(course_config, category, file_name):
+    course_config['uploaded_files'][category].remove(file_name)
+    # the same name may still be used by another category of the course
+    if not any(file_name in files for files in course_config['uploaded_files'].values()):
+        course_config.get('file_hashes', {}).pop(file_name, None)
+
+
+def invalidate_course(courses_collection, course_code):
+    bump_index_version(courses_collection, course_code)
+    course_pool.invalidate(course_code)
+    answer_cache.invalidate(course_code)
+
+
+def get_response_sources(resp):
+    return [{
+        "file_name": node.node.metadata.get("file_name", ""),
+        "text": node.node.get_content()[:500],
+    } for node in resp.source_nodes]
+
+
+def lookup_cached_answer(agent, course_code, index_version, user_input):
+    # only first questions are cached, later answers depend on the conversation.
+    # returns (cached entry or None, question embedding or None)
+    from llama_index.llms import ChatMessage, MessageRole
+    from model import get_embed_model
+
+    if len(agent.chat_history) != 0:
+        return None, None
+    embedding = get_embed_model().get_query_embedding(user_input)
+    cached = answer_cache.lookup(course_code, index_version, embedding, user_input)
+    if cached is not None:
+        agent.memory.put(ChatMessage(role=MessageRole.USER, content=user_input))
+        agent.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=cached["answer"]))
+    return cached, embedding
+
+
+def remember_answer(course_code, index_version, user_input, embedding, answer, resp):
+    if embedding is not None:
+        answer_cache.store(course_code, index_version, user_input, embedding,
+                           answer, get_response_sources(resp))
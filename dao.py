@@ -1,3 +1,11 @@
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING
+
+from metrics import timed
+
+
+@timed("mongo.get_course_config")
 def get_course_config(courses_collection, course_code):
     if courses_collection.find_one({"course_code": course_code}) == None:
         # create a new course config
@@ -11,18 +19,194 @@ def get_course_config(courses_collection, course_code):
             },
             "system_prompt": "",
             "course_title": "",
-            "messages": []
         })
         return courses_collection.find_one({"course_code": course_code})
     else:
         return courses_collection.find_one({"course_code": course_code})
 
 
+@timed("mongo.find_course_config")
+def find_course_config(courses_collection, course_code):
+    # like get_course_config, but None for unknown courses instead of creating them
+    return courses_collection.find_one({"course_code": course_code})
+
+
+@timed("mongo.update_course_config")
 def update_course_config(courses_collection, course_code, new_config):
-    if courses_collection.find_one({"course_code": course_code}) == None:
-        # insert to config
-        courses_collection.insert_one(new_config)
-    else:
-        # update config
+    # messages live in their own collection and index_version is only ever
+    # incremented, so a stale config read can never overwrite either of them
+    new_config = {key: value for key, value in new_config.items()
+                  if key not in ("_id", "messages", "index_version")}
+    courses_collection.update_one(
+        {"course_code": course_code}, {"$set": new_config}, upsert=True)
+
+
+def get_index_version(course_config):
+    return course_config.get("index_version", 0)
+
+
+@timed("mongo.bump_index_version")
+def bump_index_version(courses_collection, course_code):
+    # every change to a course's files gets a new version, so shared caches
+    # keyed by (course_code, index_version) never serve stale indexes
+    courses_collection.update_one(
+        {"course_code": course_code}, {"$inc": {"index_version": 1}})
+
+
+def ensure_message_indexes(messages_collection):
+    messages_collection.create_index(
+        [("course_code", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)])
+
+
+@timed("mongo.add_message")
+def add_message(messages_collection, course_code, role, content):
+    messages_collection.insert_one({
+        "course_code": course_code,
+        "role": role,
+        "content": content,
+        "timestamp": datetime.utcnow(),
+    })
+
+
+@timed("mongo.get_messages")
+def get_messages(messages_collection, course_code, limit=20, before=None, after=None):
+    # before/after are the messages at the edges of what is already loaded,
+    # returns up to limit messages next to them in chronological order
+    query = {"course_code": course_code}
+    order = DESCENDING
+    if before is not None:
+        query["$or"] = [
+            {"timestamp": {"$lt": before["timestamp"]}},
+            {"timestamp": before["timestamp"], "_id": {"$lt": before["_id"]}},
+        ]
+    elif after is not None:
+        query["$or"] = [
+            {"timestamp": {"$gt": after["timestamp"]}},
+            {"timestamp": after["timestamp"], "_id": {"$gt": after["_id"]}},
+        ]
+        order = ASCENDING
+    cursor = messages_collection.find(query).sort(
+        [("timestamp", order), ("_id", order)])
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    messages = list(cursor)
+    if order == DESCENDING:
+        messages.reverse()
+    return messages
+
+
+@timed("mongo.delete_messages")
+def delete_messages(messages_collection, course_code):
+    messages_collection.delete_many({"course_code": course_code})
+
+
+@timed("mongo.get_recent_course_codes")
+def get_recent_course_codes(messages_collection, limit=3, since=None):
+    # courses with the latest messages first, only messages after since count
+    pipeline = []
+    if since is not None:
+        pipeline.append({"$match": {"timestamp": {"$gte": since}}})
+    pipeline += [
+        {"$group": {"_id": "$course_code", "last": {"$max": "$timestamp"}}},
+        {"$sort": {"last": DESCENDING}},
+        {"$limit": limit},
+    ]
+    return [row["_id"] for row in messages_collection.aggregate(pipeline)]
+
+
+def migrate_embedded_messages(courses_collection, messages_collection):
+    # move histories stored in the course document into the messages collection
+    for course_config in courses_collection.find({"messages": {"$exists": True}}):
+        messages = course_config.get("messages") or []
+        if messages:
+            # old messages have no timestamp, keep their order after the
+            # creation time of the course document
+            start = course_config["_id"].generation_time.replace(tzinfo=None)
+            messages_collection.insert_many([{
+                "course_code": course_config["course_code"],
+                "role": message["role"],
+                "content": message["content"],
+                "timestamp": start + timedelta(milliseconds=i),
+            } for i, message in enumerate(messages)])
         courses_collection.update_one(
-        {"course_code": course_code}, {"$set": new_config})
+            {"_id": course_config["_id"]}, {"$unset": {"messages": ""}})
+        print(f"migrated {len(messages)} messages of {course_config['course_code']}")
+
+
+ACTIVE_JOB_STATUSES = ["queued", "running"]
+
+
+def ensure_job_indexes(jobs_collection):
+    jobs_collection.create_index([("course_code", ASCENDING), ("created_at", DESCENDING)])
+    jobs_collection.create_index([("status", ASCENDING)])
+
+
+@timed("mongo.create_ingest_job")
+def create_ingest_job(jobs_collection, course_code, category, max_attempts=3):
+    now = datetime.utcnow()
+    return jobs_collection.insert_one({
+        "course_code": course_code,
+        "category": category,
+        "status": "queued",
+        "cancel_requested": False,
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "progress": [],
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }).inserted_id
+
+
+@timed("mongo.get_ingest_job")
+def get_ingest_job(jobs_collection, job_id):
+    return jobs_collection.find_one({"_id": job_id})
+
+
+@timed("mongo.get_ingest_jobs")
+def get_ingest_jobs(jobs_collection, course_code, limit=10):
+    return list(jobs_collection.find({"course_code": course_code})
+                .sort("created_at", DESCENDING).limit(limit))
+
+
+@timed("mongo.get_active_ingest_jobs")
+def get_active_ingest_jobs(jobs_collection, course_code=None):
+    query = {"status": {"$in": ACTIVE_JOB_STATUSES}}
+    if course_code is not None:
+        query["course_code"] = course_code
+    return list(jobs_collection.find(query).sort("created_at", ASCENDING))
+
+
+@timed("mongo.get_latest_ingest_jobs")
+def get_latest_ingest_jobs(jobs_collection, course_code):
+    # the newest job of each category of the course, by category
+    jobs = jobs_collection.aggregate([
+        {"$match": {"course_code": course_code}},
+        {"$sort": {"created_at": DESCENDING}},
+        {"$group": {"_id": "$category", "job": {"$first": "$$ROOT"}}},
+    ])
+    return {row["_id"]: row["job"] for row in jobs}
+
+
+@timed("mongo.update_ingest_job")
+def update_ingest_job(jobs_collection, job_id, **fields):
+    fields["updated_at"] = datetime.utcnow()
+    jobs_collection.update_one({"_id": job_id}, {"$set": fields})
+
+
+@timed("mongo.set_ingest_job_file_stage")
+def set_ingest_job_file_stage(jobs_collection, job_id, file_name, stage):
+    jobs_collection.update_one(
+        {"_id": job_id, "progress.file": file_name},
+        {"$set": {"progress.$.stage": stage, "updated_at": datetime.utcnow()}})
+
+
+@timed("mongo.cancel_ingest_job")
+def cancel_ingest_job(jobs_collection, job_id):
+    # queued jobs are cancelled right away, running ones stop at the next stage
+    jobs_collection.update_one(
+        {"_id": job_id, "status": "queued"},
+        {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}})
+    jobs_collection.update_one(
+        {"_id": job_id, "status": "running"},
+        {"$set": {"cancel_requested": True, "updated_at": datetime.utcnow()}})
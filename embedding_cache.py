@@ -0,0 +1,200 @@
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import Any, List
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+
+
+DEFAULT_CACHE_PATH = os.path.join("db", "embedding_cache.sqlite")
+DEFAULT_MAX_ENTRIES = int(os.getenv("TUTOR_EMBED_CACHE_MAX_ENTRIES", "500000"))
+EMBED_CONCURRENCY = int(os.getenv("TUTOR_EMBED_CONCURRENCY", "4"))
+EMBED_QUERY_CONCURRENCY = int(os.getenv("TUTOR_EMBED_QUERY_CONCURRENCY", "16"))
+
+# process-wide cap on document batches in flight, shared by every index build
+# so concurrent builds stay under the API rate limits
+_inflight = threading.BoundedSemaphore(EMBED_CONCURRENCY)
+# questions get slots of their own, a running ingestion never queues a chat
+_query_inflight = threading.BoundedSemaphore(EMBED_QUERY_CONCURRENCY)
+
+
+async def acquire_async(semaphore):
+    # threading semaphores block, so the wait runs in a thread. when the
+    # caller is cancelled the thread may still get a slot later, it is given
+    # back as soon as it does.
+    future = asyncio.get_running_loop().run_in_executor(None, semaphore.acquire)
+    try:
+        await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(lambda f: semaphore.release())
+        raise
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    # sqlite file keyed by (model name, text hash), evicted by least recent use
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "last_used REAL NOT NULL, PRIMARY KEY (model, hash))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, model, hashes):
+        found = {}
+        if not hashes:
+            return found
+        unique = list(set(hashes))
+        with self._lock:
+            # sqlite limits the number of bound parameters per statement
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, h) for h in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, model, items):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, h, array("f", vector).tobytes(), now)
+                 for h, vector in items.items()],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN ("
+            "SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (count - self.max_entries,),
+        )
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_embedding_store(path=DEFAULT_CACHE_PATH):
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = EmbeddingStore(path)
+        return _stores[path]
+
+
+class CachedEmbedding(BaseEmbedding):
+    # wraps another embed model, only texts never seen before reach it
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingStore = PrivateAttr()
+
+    def __init__(self, embed_model, store=None, **kwargs: Any):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._store = store or get_embedding_store()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _cache_key(self, query=False):
+        # some models embed queries differently from documents
+        return f"{self.model_name}#query" if query else self.model_name
+
+    def _lookup(self, texts, key):
+        hashes = [text_hash(text) for text in texts]
+        found = self._store.get_many(key, hashes)
+        missing = {}
+        for text, h in zip(texts, hashes):
+            if h not in found and h not in missing:
+                missing[h] = text
+        return hashes, found, missing
+
+    def _write_back(self, key, found, missing, vectors):
+        new = dict(zip(missing.keys(), vectors))
+        self._store.put_many(key, new)
+        found.update(new)
+
+    def _cached(self, texts, key, embed_fn, limit=_inflight):
+        hashes, found, missing = self._lookup(texts, key)
+        if missing:
+            with limit:
+                vectors = embed_fn(list(missing.values()))
+            self._write_back(key, found, missing, vectors)
+        return [found[h] for h in hashes]
+
+    async def _acached(self, texts, key, aembed_fn, limit=_inflight):
+        hashes, found, missing = self._lookup(texts, key)
+        if missing:
+            await acquire_async(limit)
+            try:
+                vectors = await aembed_fn(list(missing.values()))
+            finally:
+                limit.release()
+            self._write_back(key, found, missing, vectors)
+        return [found[h] for h in hashes]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._cached(
+            [query], self._cache_key(query=True),
+            lambda texts: [self._embed_model._get_query_embedding(texts[0])],
+            limit=_query_inflight,
+        )[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        async def embed(texts):
+            return [await self._embed_model._aget_query_embedding(texts[0])]
+        return (await self._acached([query], self._cache_key(query=True), embed,
+                                    limit=_query_inflight))[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cached(texts, self._cache_key(), self._embed_model._get_text_embeddings)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._acached(texts, self._cache_key(), self._embed_model._aget_text_embeddings)
@@ -0,0 +1,246 @@
+import os
+import json
+from typing import Any, List, Optional
+
+import faiss
+import numpy as np
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+
+FAISS_INDEX_FILE = "faiss.index"
+FAISS_IDS_FILE = "faiss_ids.json"
+# ivf is the only type that is both sublinear and memory-mapped on load
+FAISS_INDEX_TYPE = os.getenv("TUTOR_FAISS_INDEX", "ivf")
+FAISS_IVF_NLIST = int(os.getenv("TUTOR_FAISS_IVF_NLIST", "256"))
+FAISS_IVF_NPROBE = int(os.getenv("TUTOR_FAISS_IVF_NPROBE", "16"))
+FAISS_HNSW_M = int(os.getenv("TUTOR_FAISS_HNSW_M", "32"))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("TUTOR_FAISS_HNSW_EF_SEARCH", "64"))
+# ivf lists are retrained once the corpus has this many vectors per list
+FAISS_IVF_POINTS_PER_LIST = 39
+# filtered queries score up to this many allowed vectors exactly
+FAISS_EXACT_FILTER_MAX = int(os.getenv("TUTOR_FAISS_EXACT_FILTER_MAX", "20000"))
+# metadata kept per vector so queries can be filtered, e.g. to one course
+FILTER_KEYS = ("course_code", "category")
+
+
+def is_mapped(faiss_index):
+    # faiss only maps the inverted lists of ivf indexes, other types are read
+    # into memory whatever the flags say
+    try:
+        invlists = faiss.extract_index_ivf(faiss_index).invlists
+    except RuntimeError:
+        return False
+    return isinstance(faiss.downcast_InvertedLists(invlists), faiss.OnDiskInvertedLists)
+
+
+class FaissMmapVectorStore(VectorStore):
+    # faiss index persisted as a binary file, so vectors are never
+    # deserialized into python lists. ivf indexes are memory-mapped on load,
+    # flat and hnsw are read into memory. vectors are normalized and searched
+    # by inner product, i.e. cosine similarity like the default store. flat
+    # is exact, ivf and hnsw are approximate and sublinear.
+
+    stores_text: bool = False
+    is_embedding_query: bool = True
+
+    def __init__(self, index_type=FAISS_INDEX_TYPE, faiss_index=None, ids=None,
+                 persist_dir=None, mmapped=False):
+        if index_type not in ("flat", "ivf", "hnsw"):
+            raise ValueError(f"Unknown faiss index type: {index_type}")
+        self.index_type = index_type
+        self._faiss_index = faiss_index
+        ids = ids or {}
+        self._next_id = ids.get("next_id", 0)
+        self._node_ids = {int(k): v for k, v in ids.get("node_ids", {}).items()}
+        self._ref_docs = ids.get("ref_docs", {})
+        # ids removed from index types that cannot remove vectors in place
+        self._deleted = set(ids.get("deleted", []))
+        self._tags = {int(k): v for k, v in ids.get("tags", {}).items()}
+        self._tag_index = {}
+        for faiss_id, tags in self._tags.items():
+            self._index_tags(faiss_id, tags)
+        self._persist_dir = persist_dir
+        self._mmapped = mmapped
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir):
+        with open(os.path.join(persist_dir, FAISS_IDS_FILE)) as f:
+            ids = json.load(f)
+        index_path = os.path.join(persist_dir, FAISS_INDEX_FILE)
+        faiss_index, mmapped = None, False
+        if os.path.exists(index_path):
+            if ids["index_type"] == "ivf":
+                faiss_index = faiss.read_index(
+                    index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                mmapped = is_mapped(faiss_index)
+            else:
+                faiss_index = faiss.read_index(index_path)
+        store = cls(ids["index_type"], faiss_index, ids, persist_dir, mmapped)
+        store._set_search_params()
+        return store
+
+    @property
+    def client(self) -> Any:
+        return self._faiss_index
+
+    def _create_index(self, vectors):
+        dim = vectors.shape[1]
+        if self.index_type == "ivf":
+            # enough training points per list, or faiss warns and clusters badly
+            nlist = max(1, min(FAISS_IVF_NLIST, len(vectors) // FAISS_IVF_POINTS_PER_LIST))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+            # vectors can be read back by id, to retrain and for filtered search
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            return index
+        if self.index_type == "hnsw":
+            return faiss.IndexIDMap2(
+                faiss.IndexHNSWFlat(dim, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT))
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+    def _set_search_params(self):
+        if self._faiss_index is None:
+            return
+        if self.index_type == "ivf":
+            self._faiss_index.nprobe = FAISS_IVF_NPROBE
+        elif self.index_type == "hnsw":
+            faiss.downcast_index(self._faiss_index.index).hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+
+    def _maybe_retrain(self):
+        # an ivf index is trained on the first file it is given, which is
+        # usually too few vectors for many lists. once the corpus could fill
+        # twice as many lists it is trained again on all of its vectors, so
+        # the lists grow with the corpus and each probe stays small.
+        index = self._faiss_index
+        nlist = min(FAISS_IVF_NLIST, index.ntotal // FAISS_IVF_POINTS_PER_LIST)
+        if self.index_type != "ivf" or nlist < 2 * index.nlist:
+            return
+        faiss_ids = np.array(sorted(self._node_ids), dtype=np.int64)
+        vectors = index.reconstruct_batch(faiss_ids)
+        print(f"retraining faiss ivf index, {index.nlist} -> {nlist} lists for {len(faiss_ids)} vectors")
+        self._faiss_index = self._create_index(vectors)
+        self._faiss_index.add_with_ids(vectors, faiss_ids)
+        self._set_search_params()
+
+    def _index_tags(self, faiss_id, tags):
+        for key, value in tags.items():
+            self._tag_index.setdefault((key, value), set()).add(faiss_id)
+
+    def _filtered_search(self, vector, k, faiss_ids):
+        faiss_ids = np.array(sorted(faiss_ids), dtype=np.int64)
+        if self.index_type == "ivf" and len(faiss_ids) > FAISS_EXACT_FILTER_MAX:
+            # a large course fills enough lists that nprobe of them find it
+            params = faiss.SearchParametersIVF(
+                sel=faiss.IDSelectorBatch(faiss_ids), nprobe=FAISS_IVF_NPROBE)
+            return self._faiss_index.search(vector, k, params=params)
+        # id mapped indexes take no search params in faiss 1.7, and a small
+        # course's vectors may sit outside the probed ivf lists. score the
+        # allowed vectors exactly instead.
+        scores = self._faiss_index.reconstruct_batch(faiss_ids) @ vector[0]
+        top = np.argsort(-scores)[:k]
+        return scores[top][None, :], faiss_ids[top][None, :]
+
+    def _ensure_writable(self):
+        # a memory-mapped index is read only, load it fully before changing it
+        if self._mmapped:
+            self._faiss_index = faiss.read_index(
+                os.path.join(self._persist_dir, FAISS_INDEX_FILE))
+            self._mmapped = False
+            self._set_search_params()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if len(nodes) == 0:
+            return []
+        vectors = np.array([node.get_embedding() for node in nodes], dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        self._ensure_writable()
+        if self._faiss_index is None:
+            self._faiss_index = self._create_index(vectors)
+            self._set_search_params()
+        ids = np.arange(self._next_id, self._next_id + len(nodes), dtype=np.int64)
+        self._faiss_index.add_with_ids(vectors, ids)
+        self._next_id += len(nodes)
+        for faiss_id, node in zip(ids.tolist(), nodes):
+            self._node_ids[faiss_id] = node.node_id
+            self._ref_docs.setdefault(node.ref_doc_id or "", []).append(faiss_id)
+            tags = {key: node.metadata[key] for key in FILTER_KEYS if key in node.metadata}
+            if tags:
+                self._tags[faiss_id] = tags
+                self._index_tags(faiss_id, tags)
+        self._maybe_retrain()
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        faiss_ids = self._ref_docs.pop(ref_doc_id, [])
+        if len(faiss_ids) == 0:
+            return
+        for faiss_id in faiss_ids:
+            self._node_ids.pop(faiss_id, None)
+            for key, value in self._tags.pop(faiss_id, {}).items():
+                self._tag_index.get((key, value), set()).discard(faiss_id)
+        self._ensure_writable()
+        try:
+            self._faiss_index.remove_ids(np.array(faiss_ids, dtype=np.int64))
+        except RuntimeError:
+            # hnsw cannot remove vectors, skip them at query time instead
+            self._deleted.update(faiss_ids)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if self._faiss_index is None or self._faiss_index.ntotal == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        vector = np.array([query.query_embedding], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        k = min(query.similarity_top_k + len(self._deleted), self._faiss_index.ntotal)
+        if query.filters is not None and len(query.filters.filters) != 0:
+            # exact match filters only. only the matching vectors are scored,
+            # so other courses can never crowd this course out of the top k
+            allowed = None
+            for f in query.filters.legacy_filters():
+                matching = self._tag_index.get((f.key, f.value), set())
+                allowed = matching if allowed is None else allowed & matching
+            allowed = (allowed or set()) - self._deleted
+            if len(allowed) == 0:
+                return VectorStoreQueryResult(similarities=[], ids=[])
+            scores, faiss_ids = self._filtered_search(
+                vector, min(query.similarity_top_k, len(allowed)), allowed)
+        else:
+            scores, faiss_ids = self._faiss_index.search(vector, k)
+        similarities, node_ids = [], []
+        for score, faiss_id in zip(scores[0].tolist(), faiss_ids[0].tolist()):
+            if faiss_id < 0 or faiss_id in self._deleted or faiss_id not in self._node_ids:
+                continue
+            similarities.append(score)
+            node_ids.append(self._node_ids[faiss_id])
+            if len(node_ids) == query.similarity_top_k:
+                break
+        return VectorStoreQueryResult(similarities=similarities, ids=node_ids)
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        # persist_path points at the default json vector store file, the faiss
+        # files are written next to it instead
+        persist_dir = os.path.dirname(persist_path)
+        os.makedirs(persist_dir, exist_ok=True)
+        # a mapped index is unchanged since it was read from this directory
+        if self._faiss_index is not None and not (
+                self._mmapped and persist_dir == self._persist_dir):
+            index_path = os.path.join(persist_dir, FAISS_INDEX_FILE)
+            faiss.write_index(self._faiss_index, index_path + ".tmp")
+            os.replace(index_path + ".tmp", index_path)
+        ids_path = os.path.join(persist_dir, FAISS_IDS_FILE)
+        with open(ids_path + ".tmp", "w") as f:
+            json.dump({
+                "index_type": self.index_type,
+                "next_id": self._next_id,
+                "node_ids": self._node_ids,
+                "ref_docs": self._ref_docs,
+                "deleted": sorted(self._deleted),
+                "tags": self._tags,
+            }, f)
+        os.replace(ids_path + ".tmp", ids_path)
+        self._persist_dir = persist_dir
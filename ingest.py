@@ -0,0 +1,164 @@
+import os
+import uuid
+import shutil
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from dao import (
+    ACTIVE_JOB_STATUSES,
+    get_course_config,
+    create_ingest_job,
+    get_ingest_job,
+    get_active_ingest_jobs,
+    get_latest_ingest_jobs,
+    update_ingest_job,
+    set_ingest_job_file_stage,
+)
+
+
+CATEGORIES = ['slides', 'assignments', 'syllabus']
+# one per category by default, a new course builds its categories concurrently
+INGEST_WORKERS = int(os.getenv("TUTOR_INGEST_WORKERS", str(len(CATEGORIES))))
+INGEST_RETRY_DELAY_SECONDS = float(os.getenv("TUTOR_INGEST_RETRY_DELAY_SECONDS", "10"))
+STAGES = ['queued', 'parsed', 'chunked', 'embedded', 'persisted']
+
+
+def course_index_dir(course_code, category):
+    return os.path.join('db', f'{course_code}_{category}_index')
+
+
+def category_index_ready(course_code, category):
+    # llama_index is only imported once an index is looked at
+    from model import index_ready
+    from unified_index import INDEX_LAYOUT, unified_index
+
+    if INDEX_LAYOUT == "unified":
+        return unified_index.ready(course_code, category)
+    return index_ready(course_index_dir(course_code, category))
+
+
+def course_input_files(course_config, course_code, category):
+    return [os.path.join('document', course_code, file)
+            for file in course_config['uploaded_files'].get(category, [])]
+
+
+def course_file_set(course_config, category):
+    # the files of a category with their content hashes, to tell whether a
+    # job ran on the files the course has now
+    file_hashes = course_config.get('file_hashes', {})
+    return {file: file_hashes.get(file) for file in course_config['uploaded_files'].get(category, [])}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class IngestWorker:
+    # runs index builds in background threads, with every job and its per-file
+    # progress kept in mongo. a job always indexes the current file list of its
+    # course category into a copy of the index, which replaces the live index
+    # only once it is fully persisted. on_done(course_code) is called after.
+
+    def __init__(self, courses_collection, jobs_collection, on_done=None, max_workers=INGEST_WORKERS):
+        self.courses_collection = courses_collection
+        self.jobs_collection = jobs_collection
+        self.on_done = on_done
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._index_locks = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        # pick up jobs left behind by a previous process
+        for job in get_active_ingest_jobs(self.jobs_collection):
+            update_ingest_job(self.jobs_collection, job["_id"], status="queued")
+            self._executor.submit(self._run, job["_id"])
+
+    def enqueue(self, course_code, category):
+        job_id = create_ingest_job(self.jobs_collection, course_code, category)
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def ensure_indexed(self, course_code, course_config):
+        # enqueue categories that have files but no usable index and no job
+        # yet. a job that failed or was cancelled is not retried for the same
+        # files, only once they change or the job is retried by hand.
+        latest = get_latest_ingest_jobs(self.jobs_collection, course_code)
+        for category in CATEGORIES:
+            if len(course_input_files(course_config, course_code, category)) == 0:
+                continue
+            job = latest.get(category)
+            if job is not None and (job["status"] in ACTIVE_JOB_STATUSES or (
+                    job["status"] in ("failed", "cancelled") and
+                    job.get("files", course_file_set(course_config, category)) ==
+                    course_file_set(course_config, category))):
+                continue
+            if not category_index_ready(course_code, category):
+                self.enqueue(course_code, category)
+
+    def _index_lock(self, save_dir):
+        with self._lock:
+            return self._index_locks.setdefault(save_dir, threading.Lock())
+
+    def _report(self, job_id, input_file, stage):
+        job = get_ingest_job(self.jobs_collection, job_id)
+        if job["cancel_requested"]:
+            raise JobCancelled()
+        set_ingest_job_file_stage(self.jobs_collection, job_id, os.path.basename(input_file), stage)
+
+    def _retry(self, job_id):
+        self._executor.submit(self._run, job_id)
+
+    def _run(self, job_id):
+        from model import get_index, live_index_dir, swap_index_dir
+        from llm_metrics import course_callback_manager
+        from unified_index import INDEX_LAYOUT, unified_index
+
+        job = get_ingest_job(self.jobs_collection, job_id)
+        if job is None or job["status"] != "queued":
+            return
+        course_code, category = job["course_code"], job["category"]
+        save_dir = course_index_dir(course_code, category)
+        # a directory of its own for every run, the live one is never reused
+        tmp_dir = f"{save_dir}-{uuid.uuid4().hex}"
+        with self._index_lock(save_dir):
+            course_config = get_course_config(self.courses_collection, course_code)
+            input_files = course_input_files(course_config, course_code, category)
+            attempts = job["attempts"] + 1
+            update_ingest_job(
+                self.jobs_collection, job_id, status="running", attempts=attempts, error=None,
+                files=course_file_set(course_config, category),
+                progress=[{"file": os.path.basename(f), "stage": "queued"} for f in input_files])
+            progress = lambda input_file, stage: self._report(job_id, input_file, stage)
+            try:
+                if INDEX_LAYOUT == "unified":
+                    # the unified index writes a new shard and swaps it in itself
+                    unified_index.sync(course_code, category, input_files, progress=progress)
+                else:
+                    live_dir = live_index_dir(save_dir)
+                    if os.path.exists(live_dir):
+                        shutil.copytree(live_dir, tmp_dir)
+                    get_index(input_files, tmp_dir, progress=progress,
+                              callback_manager=course_callback_manager(course_code))
+                    swap_index_dir(tmp_dir, save_dir)
+            except JobCancelled:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                update_ingest_job(self.jobs_collection, job_id, status="cancelled")
+                return
+            except Exception as e:
+                traceback.print_exc()
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if attempts < job["max_attempts"]:
+                    update_ingest_job(self.jobs_collection, job_id, status="queued", error=str(e))
+                    threading.Timer(INGEST_RETRY_DELAY_SECONDS * attempts,
+                                    self._retry, args=(job_id,)).start()
+                else:
+                    update_ingest_job(self.jobs_collection, job_id, status="failed", error=str(e))
+                return
+            # unchanged files were already in the index
+            update_ingest_job(
+                self.jobs_collection, job_id, status="succeeded",
+                progress=[{"file": os.path.basename(f), "stage": "persisted"} for f in input_files])
+        print(f"ingested {course_code} {category}")
+        if self.on_done is not None:
+            self.on_done(course_code)
@@ -0,0 +1,202 @@
+import os
+import re
+import json
+import math
+import heapq
+import threading
+from concurrent.futures import Future
+from typing import List
+
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+
+from metrics import span
+
+
+LEXICAL_INDEX_FILE = "bm25.json"
+# rrf or weighted fuse the lexical and vector results, vector keeps the old
+# vector only retrieval
+HYBRID_FUSION = os.getenv("TUTOR_HYBRID_FUSION", "rrf")
+RRF_K = int(os.getenv("TUTOR_HYBRID_RRF_K", "60"))
+# weight of the vector scores for weighted fusion, the lexical ones get the rest
+HYBRID_ALPHA = float(os.getenv("TUTOR_HYBRID_ALPHA", "0.5"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+FILTER_KEYS = ("course_code", "category")
+
+STOPWORDS = set("""
+a an and are as at be but by can could did do does for from had has have how i if in into is it its
+me my of on or our so than that the their them then there these they this to was we were what when
+where which who why will with would you your about explain tell please
+""".split())
+
+
+def tokenize(text):
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in STOPWORDS]
+
+
+class LexicalIndex:
+    # bm25 over the sentence nodes of an index, kept next to it like the
+    # sentence buffer. only each node's term counts are persisted, the
+    # postings lists are rebuilt when the index is loaded.
+
+    def __init__(self, nodes=None):
+        self._nodes = {}
+        self._docs = {}
+        self._postings = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+        for node_id, entry in (nodes or {}).items():
+            self._add_entry(node_id, entry)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir):
+        # None when the index was built before it had a lexical index
+        path = os.path.join(persist_dir, LEXICAL_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def persist(self, persist_dir):
+        path = os.path.join(persist_dir, LEXICAL_INDEX_FILE)
+        with self._lock:
+            data = json.dumps(self._nodes)
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _add_entry(self, node_id, entry):
+        self._nodes[node_id] = entry
+        self._docs.setdefault(entry["doc"], []).append(node_id)
+        self._total_length += entry["length"]
+        for term, count in entry["tf"].items():
+            self._postings.setdefault(term, {})[node_id] = count
+
+    def add(self, nodes):
+        with self._lock:
+            for node in nodes:
+                terms = tokenize(node.get_content())
+                tf = {}
+                for term in terms:
+                    tf[term] = tf.get(term, 0) + 1
+                tags = {key: node.metadata[key] for key in FILTER_KEYS if key in node.metadata}
+                self._add_entry(node.node_id, {"doc": node.ref_doc_id, "length": len(terms),
+                                               "tf": tf, "tags": tags})
+
+    def delete(self, ref_doc_id):
+        with self._lock:
+            for node_id in self._docs.pop(ref_doc_id, []):
+                entry = self._nodes.pop(node_id)
+                self._total_length -= entry["length"]
+                for term in entry["tf"]:
+                    postings = self._postings[term]
+                    del postings[node_id]
+                    if len(postings) == 0:
+                        del self._postings[term]
+
+    def search(self, query, top_k, filters=None):
+        # returns [(node_id, score)], best first
+        terms = set(tokenize(query))
+        tags = {f.key: f.value for f in filters.filters} if filters is not None else {}
+        with self._lock:
+            if len(terms) == 0 or len(self._nodes) == 0:
+                return []
+            n = len(self._nodes)
+            avg_length = self._total_length / n or 1.0
+            scores = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for node_id, count in postings.items():
+                    entry = self._nodes[node_id]
+                    if tags and any(entry["tags"].get(k) != v for k, v in tags.items()):
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * entry["length"] / avg_length)
+                    scores[node_id] = scores.get(node_id, 0.0) + idf * count * (BM25_K1 + 1) / (count + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return best
+
+
+def rrf_fuse(result_lists, k=RRF_K):
+    scores, nodes = {}, {}
+    for results in result_lists:
+        for rank, n in enumerate(results):
+            node_id = n.node.node_id
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank + 1)
+            nodes.setdefault(node_id, n)
+    return scores, nodes
+
+
+def weighted_fuse(result_lists, weights):
+    # scores of each list are scaled to [0, 1] first, bm25 and cosine
+    # similarity are not on the same scale
+    scores, nodes = {}, {}
+    for results, weight in zip(result_lists, weights):
+        if len(results) == 0:
+            continue
+        low = min(n.score or 0.0 for n in results)
+        high = max(n.score or 0.0 for n in results)
+        for n in results:
+            node_id = n.node.node_id
+            scaled = ((n.score or 0.0) - low) / (high - low) if high > low else 1.0
+            scores[node_id] = scores.get(node_id, 0.0) + weight * scaled
+            nodes.setdefault(node_id, n)
+    return scores, nodes
+
+
+class HybridRetriever(BaseRetriever):
+    # bm25 and vector search over the same nodes, in parallel: the lexical
+    # search on the calling thread, the vector search in a thread of its own.
+    # their results are fused.
+
+    def __init__(self, vector_retriever, lexical_index, docstore, similarity_top_k=6, filters=None,
+                 fusion=HYBRID_FUSION, course_code="", callback_manager=None):
+        super().__init__(callback_manager=callback_manager)
+        self._vector_retriever = vector_retriever
+        self._lexical_index = lexical_index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        self._filters = filters
+        self._fusion = fusion
+        self._course_code = course_code
+
+    def _lexical_nodes(self, results):
+        nodes = []
+        for node_id, score in results:
+            # the lexical index may still list a node the docstore dropped
+            node = self._docstore.get_document(node_id, raise_error=False)
+            if node is not None:
+                nodes.append(NodeWithScore(node=node, score=score))
+        return nodes
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._fusion == "vector" or len(self._lexical_index) == 0:
+            return self._vector_retriever.retrieve(query_bundle)
+        future = Future()
+
+        def vector_search():
+            try:
+                future.set_result(self._vector_retriever.retrieve(query_bundle))
+            except Exception as e:
+                future.set_exception(e)
+
+        # a thread per query, not a shared pool: a pool would cap concurrent
+        # vector searches below the callers' own thread pools
+        threading.Thread(target=vector_search, daemon=True).start()
+        with span("lexical_search", course=self._course_code):
+            results = self._lexical_index.search(
+                query_bundle.query_str, self._similarity_top_k, self._filters)
+        lexical_nodes = self._lexical_nodes(results)
+        vector_nodes = future.result()
+        if self._fusion == "weighted":
+            scores, nodes = weighted_fuse([vector_nodes, lexical_nodes], [HYBRID_ALPHA, 1 - HYBRID_ALPHA])
+        else:
+            scores, nodes = rrf_fuse([vector_nodes, lexical_nodes])
+        best = sorted(scores, key=lambda node_id: -scores[node_id])[:self._similarity_top_k]
+        return [NodeWithScore(node=nodes[node_id].node, score=scores[node_id]) for node_id in best]
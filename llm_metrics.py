@@ -0,0 +1,98 @@
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+import tiktoken
+from llama_index.callbacks import CallbackManager
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+
+from metrics import metrics
+
+
+_encoding = None
+
+
+def count_tokens(text):
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.encoding_for_model("gpt-4")
+    return len(_encoding.encode(text or "", disallowed_special=()))
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    # times llama_index events (embedding batches, retrieval, llm and tool
+    # round trips) and counts their tokens, all labelled with the course
+
+    EVENT_NAMES = {
+        CBEventType.EMBEDDING: "embedding_batch",
+        CBEventType.RETRIEVE: "vector_retrieval",
+        CBEventType.LLM: "llm_round_trip",
+        CBEventType.FUNCTION_CALL: "tool_round_trip",
+        CBEventType.SYNTHESIZE: "synthesize",
+        CBEventType.QUERY: "query",
+    }
+
+    def __init__(self, course_code=""):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.course_code = course_code
+        self._starts = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        if event_type in self.EVENT_NAMES:
+            with self._lock:
+                self._starts[event_id] = (time.perf_counter(), payload or {})
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        with self._lock:
+            start = self._starts.pop(event_id, None)
+        if start is None:
+            return
+        started_at, start_payload = start
+        payload = payload or {}
+        labels = {"course": self.course_code}
+        if event_type == CBEventType.FUNCTION_CALL:
+            tool = start_payload.get(EventPayload.TOOL)
+            labels["tool"] = getattr(tool, "name", "")
+        metrics.observe(self.EVENT_NAMES[event_type], time.perf_counter() - started_at, **labels)
+        if event_type == CBEventType.EMBEDDING:
+            chunks = payload.get(EventPayload.CHUNKS) or []
+            metrics.incr("embedding_tokens", sum(count_tokens(c) for c in chunks), **labels)
+        elif event_type == CBEventType.LLM:
+            messages = start_payload.get(EventPayload.MESSAGES) or []
+            prompt = "".join(str(m.content or "") for m in messages) or \
+                str(start_payload.get(EventPayload.PROMPT, ""))
+            response = payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION)
+            completion = getattr(getattr(response, "message", None), "content", None) or \
+                getattr(response, "text", "")
+            metrics.incr("llm_prompt_tokens", count_tokens(prompt), **labels)
+            metrics.incr("llm_completion_tokens", count_tokens(str(completion or "")), **labels)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
+
+
+def course_callback_manager(course_code):
+    return CallbackManager([MetricsCallbackHandler(course_code)])
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+
+
+METRICS_FILE = os.getenv("TUTOR_METRICS_FILE", os.path.join("db", "metrics.json"))
+METRICS_EXPORT_SECONDS = float(os.getenv("TUTOR_METRICS_EXPORT_SECONDS", "15"))
+MAX_SAMPLES = int(os.getenv("TUTOR_METRICS_MAX_SAMPLES", "2048"))
+
+
+def percentile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class Metrics:
+    # in-process latency histograms and counters, keyed by name and labels.
+    # each histogram keeps its latest MAX_SAMPLES observations for percentiles.
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._series = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._exporter = None
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {"samples": deque(maxlen=self.max_samples), "count": 0, "total": 0.0}
+                self._series[key] = series
+            series["samples"].append(seconds)
+            series["count"] += 1
+            series["total"] += seconds
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def summary(self):
+        with self._lock:
+            items = [(key, list(series["samples"]), series["count"], series["total"])
+                     for key, series in self._series.items()]
+        rows = []
+        for (name, labels), samples, count, total in sorted(items):
+            samples.sort()
+            rows.append({
+                "name": name,
+                "labels": dict(labels),
+                "count": count,
+                "mean": total / count if count else 0.0,
+                "p50": percentile(samples, 0.50),
+                "p95": percentile(samples, 0.95),
+                "p99": percentile(samples, 0.99),
+            })
+        return rows
+
+    def counters(self):
+        with self._lock:
+            return [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())]
+
+    def export(self, path=METRICS_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"time": time.time(), "latency": self.summary(),
+                       "counters": self.counters()}, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def start_file_exporter(self, path=METRICS_FILE, interval=METRICS_EXPORT_SECONDS):
+        with self._lock:
+            if self._exporter is not None:
+                return
+            self._exporter = threading.Thread(
+                target=self._export_loop, args=(path, interval), daemon=True)
+        self._exporter.start()
+
+    def _export_loop(self, path, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.export(path)
+            except OSError as e:
+                print(f"failed to export metrics: {e}")
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def span(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name):
+    # for dao functions, which all take (collection, course_code, ...)
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            course_code = kwargs.get("course_code")
+            if course_code is None and len(args) > 1 and isinstance(args[1], str):
+                course_code = args[1]
+            with span(name, course=course_code or ""):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -2,17 +2,30 @@ from llama_index.tools import QueryEngineTool, ToolMetadata
 from llama_index import ServiceContext, VectorStoreIndex, StorageContext, load_index_from_storage, SimpleDirectoryReader, Document
 from llama_hub.file.unstructured.base import UnstructuredReader
 from llama_index.llms import OpenAI
-from llama_index.indices.postprocessor import (
-    MetadataReplacementPostProcessor,
-    SentenceTransformerRerank
-)
-from llama_index.node_parser import SentenceWindowNodeParser
 from llama_index.embeddings import OpenAIEmbedding
+from llama_index.vector_stores import SimpleVectorStore
+from llama_index.node_parser.text.utils import split_by_sentence_tokenizer
 from llama_index.agent import OpenAIAgent
+from llama_index.query_engine import RetrieverQueryEngine
+from embedding_cache import CachedEmbedding
+from blob_store import blob_store
+from rerank import SharedSentenceTransformerRerank
+from sentence_window import CompactSentenceWindowNodeParser, SentenceBuffer, WindowReplacementPostProcessor
+from lexical_index import LexicalIndex, HybridRetriever
+from metrics import metrics, span
+from llm_metrics import course_callback_manager
+from router import ROUTER_ENABLED, ToolRouter, RoutedAgent
+from context_budget import HISTORY_TOKEN_BUDGET, BudgetChatMemory, ContextBudgetPostProcessor
 
 
 import os
+import json
+import time
+import shutil
+import hashlib
 import openai
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,81 +34,380 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
+VECTOR_STORE_TYPE = os.getenv("TUTOR_VECTOR_STORE", "simple")
+
+
+def sentence_window_parser(sentence_buffer=None, lexical_index=None, window_size=3):
+    # create the sentence window node parser w/ default settings, windows are
+    # kept as sentence ranges into a buffer stored next to the index, and
+    # sentence splits are cached by the hash of the text
+    return CompactSentenceWindowNodeParser.from_defaults(
+        sentence_buffer=sentence_buffer,
+        lexical_index=lexical_index,
+        sentence_splitter=blob_store.cached_splitter(split_by_sentence_tokenizer()),
+        window_size=window_size,
+        window_metadata_key="window",
+        original_text_metadata_key="original_text",
+    )
+
+
 def build_sentence_window_index(
     documents,
     llm,
     embed_model="local:BAAI/bge-small-en-v1.5",
     sentence_window_size=3,
     save_dir="sentence_index",
+    vector_store_type=VECTOR_STORE_TYPE,
+    callback_manager=None,
 ):
-    # create the sentence window node parser w/ default settings
-    node_parser = SentenceWindowNodeParser.from_defaults(
-        window_size=sentence_window_size,
-        window_metadata_key="window",
-        original_text_metadata_key="original_text",
-    )
+    # the bm25 index of the nodes is stored next to the index too. without a
+    # save_dir the index is only kept in memory.
+    if save_dir is None:
+        lexical_index, sentence_buffer = LexicalIndex(), None
+    else:
+        lexical_index = LexicalIndex.from_persist_dir(save_dir)
+        sentence_buffer = SentenceBuffer.from_persist_dir(save_dir)
+    node_parser = sentence_window_parser(sentence_buffer, lexical_index, sentence_window_size)
     sentence_context = ServiceContext.from_defaults(
         llm=llm,
         embed_model=embed_model,
         node_parser=node_parser,
+        callback_manager=callback_manager,
     )
-    if not os.path.exists(save_dir):
+    if vector_store_type == "faiss":
+        # optional dependency, only imported when a faiss store is asked for
+        from faiss_store import FaissMmapVectorStore
+    if save_dir is None or not os.path.exists(save_dir):
+        if vector_store_type == "faiss":
+            vector_store = FaissMmapVectorStore()
+        else:
+            vector_store = SimpleVectorStore()
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
         sentence_index = VectorStoreIndex.from_documents(
-            documents, service_context=sentence_context
+            documents, service_context=sentence_context, storage_context=storage_context
         )
-        sentence_index.storage_context.persist(persist_dir=save_dir)
+        if save_dir is not None:
+            persist_index(sentence_index, save_dir)
     else:
-        sentence_index = load_index_from_storage(
-            StorageContext.from_defaults(persist_dir=save_dir),
-            service_context=sentence_context,
-        )
+        with span("index_load", index=os.path.basename(save_dir)):
+            if vector_store_type == "faiss":
+                storage_context = StorageContext.from_defaults(
+                    persist_dir=save_dir,
+                    vector_store=FaissMmapVectorStore.from_persist_dir(save_dir))
+            else:
+                storage_context = StorageContext.from_defaults(persist_dir=save_dir)
+            sentence_index = load_index_from_storage(
+                storage_context,
+                service_context=sentence_context,
+            )
+        if lexical_index is None:
+            # indexes built before the lexical index get one from their nodes,
+            # it is written with the next persist
+            with span("lexical_index_build", index=os.path.basename(save_dir)):
+                node_parser.lexical_index.add(list(sentence_index.docstore.docs.values()))
 
     return sentence_index
 
 
-def get_sentence_window_query_engine(sentence_index, similarity_top_k=6, rerank_top_n=2):
-    # define postprocessors
-    postproc = MetadataReplacementPostProcessor(target_metadata_key="window")
-    rerank = SentenceTransformerRerank(
-        top_n=rerank_top_n, model="BAAI/bge-reranker-base"
-    )
+def persist_index(sentence_index, save_dir):
+    sentence_index.storage_context.persist(persist_dir=save_dir)
+    sentence_index.service_context.node_parser.sentence_buffer.persist(save_dir)
+    sentence_index.service_context.node_parser.lexical_index.persist(save_dir)
 
-    sentence_window_engine = sentence_index.as_query_engine(
-        similarity_top_k=similarity_top_k, node_postprocessors=[
-            postproc, rerank]
+
+def get_sentence_window_query_engine(sentence_index, similarity_top_k=6, rerank_top_n=2, course_code="", rerank=None,
+                                     filters=None, wrap_retriever=None):
+    # define postprocessors, windows are rebuilt from the sentence buffer
+    # for the retrieved nodes only
+    postproc = WindowReplacementPostProcessor(
+        sentence_index.service_context.node_parser.sentence_buffer,
+        target_metadata_key="window", course_code=course_code)
+    # all query engines share one lazily loaded, batching cross-encoder
+    if rerank is None:
+        rerank = SharedSentenceTransformerRerank(top_n=rerank_top_n, course_code=course_code)
+
+    # overlapping windows are merged and the context is cut to the turn's
+    # token budget, after rerank so the best windows are the ones kept
+    budget = ContextBudgetPostProcessor(
+        sentence_index.service_context.node_parser.sentence_buffer, course_code=course_code)
+
+    # bm25 and vector search run side by side and their results are fused
+    retriever = HybridRetriever(
+        sentence_index.as_retriever(similarity_top_k=similarity_top_k, filters=filters),
+        sentence_index.service_context.node_parser.lexical_index,
+        sentence_index.docstore,
+        similarity_top_k=similarity_top_k,
+        filters=filters,
+        course_code=course_code,
+        callback_manager=sentence_index.service_context.callback_manager,
+    )
+    if wrap_retriever is not None:
+        # e.g. a proxy that locks the unified index while it is searched
+        retriever = wrap_retriever(retriever)
+    sentence_window_engine = RetrieverQueryEngine.from_args(
+        retriever, service_context=sentence_index.service_context,
+        node_postprocessors=[postproc, rerank, budget],
     )
     return sentence_window_engine
 
 
-def get_index(input_files, save_dir):
+MANIFEST_FILE = "manifest.json"
+PARSE_WORKERS = int(os.getenv("TUTOR_PARSE_WORKERS", os.cpu_count() or 1))
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(save_dir):
+    manifest_path = os.path.join(save_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(save_dir, manifest):
+    manifest_path = os.path.join(save_dir, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def read_index_pointer(save_dir):
+    pointer_path = save_dir + ".json"
+    if not os.path.exists(pointer_path):
+        return None
+    with open(pointer_path) as f:
+        return json.load(f)
+
+
+def live_index_dir(save_dir):
+    # save_dir.json names the directory holding the live index. indexes
+    # written before it existed are still read from save_dir itself.
+    pointer = read_index_pointer(save_dir)
+    if pointer is None:
+        return save_dir
+    return os.path.join(os.path.dirname(save_dir), pointer["dir"])
+
+
+def swap_index_dir(new_dir, save_dir):
+    # the pointer file is replaced in one step, so readers find either the
+    # old or the new index, never none. the old directory is kept until the
+    # next swap for readers that looked it up just before this one.
+    pointer = read_index_pointer(save_dir)
+    old_dir = live_index_dir(save_dir)
+    pointer_path = save_dir + ".json"
+    with open(pointer_path + ".tmp", "w") as f:
+        json.dump({"dir": os.path.basename(new_dir),
+                   "previous": os.path.basename(old_dir)}, f)
+    os.replace(pointer_path + ".tmp", pointer_path)
+    if pointer is not None and pointer.get("previous") not in (None, pointer["dir"]):
+        shutil.rmtree(os.path.join(os.path.dirname(save_dir), pointer["previous"]),
+                      ignore_errors=True)
+
+
+def parse_file(input_file):
+    # runs in a worker process, so it only returns plain text
     documents = SimpleDirectoryReader(
-        input_files=input_files,
+        input_files=[input_file],
         file_extractor={
             ".pdf": UnstructuredReader(),
             ".html": UnstructuredReader(),
             ".txt": UnstructuredReader(),
         }
     ).load_data()
-    document = Document(text="\n\n".join([doc.text for doc in documents]))
-    print("finish loading data")
+    return "\n\n".join([doc.text for doc in documents])
+
+
+def parse_file_timed(input_file):
+    start = time.perf_counter()
+    text = parse_file(input_file)
+    return text, time.perf_counter() - start
+
+
+def record_parse(input_file, parsed):
+    text, seconds = parsed
+    metrics.observe("document_parse", seconds,
+                    file_type=os.path.splitext(input_file)[1].lower())
+    return text
+
+
+def document_id(input_file, tags=None):
+    # in the unified index the same file may be in two categories of a course
+    if not tags:
+        return input_file
+    return f"{tags['category']}:{input_file}"
+
+
+def make_file_document(input_file, text, tags=None):
+    # one document per source file, keyed by its path so it can be
+    # deleted or replaced later without touching the other files.
+    # tags (course_code, category) are copied to every node for filtering
+    tags = tags or {}
+    excluded_keys = ["file_name"] + list(tags)
+    return Document(
+        text=text,
+        doc_id=document_id(input_file, tags),
+        metadata=dict(tags, file_name=os.path.basename(input_file)),
+        excluded_embed_metadata_keys=excluded_keys,
+        excluded_llm_metadata_keys=excluded_keys,
+    )
+
+
+def load_file_documents(input_files, parse_workers=PARSE_WORKERS, tags=None, digests=None):
+    # yields documents in input order, each one as soon as it and the files
+    # before it are parsed, so embedding starts before the slowest file is done.
+    # parsed text is cached by content hash, a file that was parsed before,
+    # in any course or under any name, is not parsed again
+    digests = digests or {input_file: file_hash(input_file) for input_file in input_files}
+    texts = {input_file: blob_store.get_parsed(digests[input_file]) for input_file in input_files}
+    to_parse = [input_file for input_file in input_files if texts[input_file] is None]
+    metrics.incr("parse_cache_hit", len(input_files) - len(to_parse))
+    executor, futures = None, {}
+    if parse_workers > 1 and len(to_parse) > 1:
+        # spawned, not forked: this runs on worker threads of a process that
+        # already has the reranker, metrics and sqlite threads, and a forked
+        # child can inherit one of their locks held
+        executor = ProcessPoolExecutor(max_workers=min(parse_workers, len(to_parse)),
+                                       mp_context=multiprocessing.get_context("spawn"))
+        futures = {input_file: executor.submit(parse_file_timed, input_file)
+                   for input_file in to_parse}
+    try:
+        for input_file in input_files:
+            text = texts[input_file]
+            if text is None:
+                parsed = futures[input_file].result() if executor is not None else parse_file_timed(input_file)
+                text = record_parse(input_file, parsed)
+                blob_store.put_parsed(digests[input_file], text)
+            yield input_file, make_file_document(input_file, text, tags)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def sync_index(index, input_files, manifest, save_dir, parse_workers=PARSE_WORKERS, progress=None):
+    # progress(input_file, stage) is called as each file is parsed, chunked,
+    # embedded and persisted, it may raise to stop before anything is persisted
+    report = progress or (lambda input_file, stage: None)
+    current = {input_file: file_hash(input_file) for input_file in input_files}
+    removed = [f for f in manifest if current.get(f) != manifest[f]]
+    added = [f for f in current if manifest.get(f) != current[f]]
+    for input_file in removed:
+        print(f"removing {input_file} from {save_dir}")
+        index.delete_ref_doc(input_file, delete_from_docstore=True)
+        index.service_context.node_parser.sentence_buffer.delete(input_file)
+        index.service_context.node_parser.lexical_index.delete(input_file)
+        del manifest[input_file]
+    for input_file, document in load_file_documents(added, parse_workers, digests=current):
+        print(f"adding {input_file} to {save_dir}")
+        report(input_file, "parsed")
+        # same steps as index.insert, split up to report progress
+        with span("node_parse"):
+            nodes = index.service_context.node_parser.get_nodes_from_documents([document])
+        report(input_file, "chunked")
+        index.insert_nodes(nodes)
+        # only now the nodes carry their document metadata
+        index.service_context.node_parser.lexical_index.add(nodes)
+        index.docstore.set_document_hash(document.get_doc_id(), document.hash)
+        report(input_file, "embedded")
+        manifest[input_file] = current[input_file]
+    if removed or added or load_manifest(save_dir) is None:
+        persist_index(index, save_dir)
+        save_manifest(save_dir, manifest)
+    for input_file in added:
+        report(input_file, "persisted")
+    return index
+
+
+def get_embed_model():
+    return CachedEmbedding(OpenAIEmbedding(model="text-embedding-ada-002"))
+
+
+def is_faiss_index_dir(save_dir):
+    return os.path.exists(os.path.join(save_dir, "faiss_ids.json"))
+
+
+def index_ready(save_dir, vector_store_type=VECTOR_STORE_TYPE):
+    save_dir = live_index_dir(save_dir)
+    return load_manifest(save_dir) is not None and \
+        is_faiss_index_dir(save_dir) == (vector_store_type == "faiss")
+
+
+def get_index(input_files, save_dir, parse_workers=PARSE_WORKERS, vector_store_type=VECTOR_STORE_TYPE,
+              progress=None, load_only=False, callback_manager=None, llm=None, embed_model=None):
+    save_dir = live_index_dir(save_dir)
+    if load_only and not index_ready(save_dir, vector_store_type):
+        # not built yet, ingestion happens in the background
+        return None
+    manifest = load_manifest(save_dir)
+    if manifest is None and os.path.exists(save_dir):
+        # index was built before per-file manifests existed, rebuild it once
+        shutil.rmtree(save_dir)
+    elif manifest is not None and is_faiss_index_dir(save_dir) != (vector_store_type == "faiss"):
+        # vector store type changed, rebuilding reuses the cached embeddings
+        shutil.rmtree(save_dir)
+        manifest = None
     index = build_sentence_window_index(
-        [document],
-        llm=OpenAI(model="gpt-4", temperature=0.2),
+        [],
+        llm=llm or OpenAI(model="gpt-4", temperature=0.2),
         save_dir=save_dir,
-        embed_model=OpenAIEmbedding(model="text-embedding-ada-002"),
+        embed_model=embed_model or get_embed_model(),
+        vector_store_type=vector_store_type,
+        callback_manager=callback_manager,
     )
-    return index
+    if load_only:
+        return index
+    return sync_index(index, input_files, manifest or {}, save_dir, parse_workers, progress)
 
 
-def get_agent(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir, homework_index_dir, syllabus_index_dir, course_code, course_title, instructor_prompt=""):
+UNIFIED_CATEGORIES = {"slides": "slides", "homework": "assignments", "syllabus": "syllabus"}
+
+
+def get_tools(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir, homework_index_dir, syllabus_index_dir, course_code, course_title, load_only=False, unified=None):
     tools = []
     print(slide_inputs, homework_inputs, syllabus_inputs)
     print(slide_index_dir, homework_index_dir, syllabus_index_dir)
-    if len(slide_inputs) != 0:
-        slide_index = get_index(input_files=slide_inputs,
-                                save_dir=slide_index_dir)
+    # build or load the category indexes concurrently, cold start then costs
+    # about the slowest category instead of the sum of all three
+    index_inputs = {
+        "slides": (slide_inputs, slide_index_dir),
+        "homework": (homework_inputs, homework_index_dir),
+        "syllabus": (syllabus_inputs, syllabus_index_dir),
+    }
+    index_inputs = {name: spec for name, spec in index_inputs.items()
+                    if len(spec[0]) != 0}
+    indexes, filters, wrappers = {}, {}, {}
+    if unified is not None:
+        # categories already in the unified index share it, the others still
+        # load their own directory until they have been migrated
+        for name in list(index_inputs):
+            if unified.ready(course_code, UNIFIED_CATEGORIES[name]):
+                indexes[name] = unified.get(course_code, UNIFIED_CATEGORIES[name])
+                filters[name] = unified.filters(course_code, UNIFIED_CATEGORIES[name])
+                wrappers[name] = unified.locked_retriever
+                del index_inputs[name]
+    if len(index_inputs) != 0:
+        parse_workers = max(1, PARSE_WORKERS // len(index_inputs))
+        with ThreadPoolExecutor(max_workers=len(index_inputs)) as executor:
+            futures = {
+                name: executor.submit(
+                    get_index, input_files=input_files, save_dir=save_dir,
+                    parse_workers=parse_workers, load_only=load_only,
+                    callback_manager=course_callback_manager(course_code))
+                for name, (input_files, save_dir) in index_inputs.items()
+            }
+            indexes.update({name: future.result()
+                            for name, future in futures.items()})
+    if indexes.get("slides") is not None:
+        slide_index = indexes["slides"]
         slide_query_engine = get_sentence_window_query_engine(
-            slide_index, similarity_top_k=6)
+            slide_index, similarity_top_k=6, course_code=course_code, filters=filters.get("slides"),
+            wrap_retriever=wrappers.get("slides"))
         slide_query_engine_tool = QueryEngineTool(
             query_engine=slide_query_engine,
             metadata=ToolMetadata(
@@ -104,11 +416,11 @@ def get_agent(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir, h
             ),
         )
         tools.append(slide_query_engine_tool)
-    if len(homework_inputs) != 0:
-        practice_index = get_index(
-            input_files=homework_inputs, save_dir=homework_index_dir)
+    if indexes.get("homework") is not None:
+        practice_index = indexes["homework"]
         practice_query_engine = get_sentence_window_query_engine(
-            practice_index, similarity_top_k=6)
+            practice_index, similarity_top_k=6, course_code=course_code, filters=filters.get("homework"),
+            wrap_retriever=wrappers.get("homework"))
         practice_query_engine_tool = QueryEngineTool(
             query_engine=practice_query_engine,
             metadata=ToolMetadata(
@@ -117,11 +429,11 @@ def get_agent(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir, h
             ),
         )
         tools.append(practice_query_engine_tool)
-    if len(syllabus_inputs) != 0:
-        syllabus_index = get_index(
-            input_files=syllabus_inputs, save_dir=syllabus_index_dir)
+    if indexes.get("syllabus") is not None:
+        syllabus_index = indexes["syllabus"]
         syllabus_query_engine = get_sentence_window_query_engine(
-            syllabus_index, similarity_top_k=6)
+            syllabus_index, similarity_top_k=6, course_code=course_code, filters=filters.get("syllabus"),
+            wrap_retriever=wrappers.get("syllabus"))
         syllabus_query_engine_tool = QueryEngineTool(
             query_engine=syllabus_query_engine,
             metadata=ToolMetadata(
@@ -130,6 +442,14 @@ def get_agent(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir, h
             ),
         )
         tools.append(syllabus_query_engine_tool)
+    return tools
+
+
+def build_agent(tools, course_code, course_title, instructor_prompt="", chat_history=None, router=None):
+    # the tools hold the shared read-only indexes, the agent itself only
+    # carries the chat memory of one session. with a router, confident
+    # questions skip the llm tool selection call. the memory keeps every
+    # llm call within the history token budget.
     if len(tools) == 0:
         return None
 
@@ -147,7 +467,23 @@ def get_agent(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir, h
     You should consult course syllabus for logistic questions.
     You should also following the instructor's guidance: \n{instructor_prompt}
     """
-    agent = OpenAIAgent.from_tools(tools, llm=OpenAI(
-        model="gpt-4"), system_prompt=SYSTEM_PROMPT, verbose=True)
-    return agent
+    callback_manager = course_callback_manager(course_code)
+    llm = OpenAI(model="gpt-4", callback_manager=callback_manager)
+    memory = BudgetChatMemory(token_limit=HISTORY_TOKEN_BUDGET, chat_history=chat_history or [],
+                              course_code=course_code)
+    agent = OpenAIAgent.from_tools(tools, llm=llm, system_prompt=SYSTEM_PROMPT, memory=memory,
+        callback_manager=callback_manager, verbose=True)
+    return RoutedAgent(agent, tools, router, llm, SYSTEM_PROMPT, course_code=course_code)
+
+
+def get_router(tools, exemplars=None):
+    if not ROUTER_ENABLED or len(tools) == 0:
+        return None
+    return ToolRouter(tools, get_embed_model(), exemplars=exemplars)
+
+
+def get_agent(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir, homework_index_dir, syllabus_index_dir, course_code, course_title, instructor_prompt=""):
+    tools = get_tools(slide_inputs, homework_inputs, syllabus_inputs, slide_index_dir,
+                      homework_index_dir, syllabus_index_dir, course_code, course_title)
+    return build_agent(tools, course_code, course_title, instructor_prompt, router=get_router(tools))
 
@@ -0,0 +1,134 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+
+from llama_index.bridge.pydantic import Field
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from metrics import span
+
+
+RERANK_MODEL = os.getenv("TUTOR_RERANK_MODEL", "BAAI/bge-reranker-base")
+RERANK_MAX_BATCH = int(os.getenv("TUTOR_RERANK_MAX_BATCH", "64"))
+RERANK_MAX_WAIT_MS = float(os.getenv("TUTOR_RERANK_MAX_WAIT_MS", "5"))
+# 0 keeps torch's default thread count
+RERANK_THREADS = int(os.getenv("TUTOR_RERANK_THREADS", "0"))
+
+
+class BatchingCrossEncoder:
+    # one cross-encoder per process. requests from every session and tool are
+    # queued and scored together in a single forward pass, collecting up to
+    # max_batch_size pairs or waiting at most max_wait_ms for more to arrive
+
+    def __init__(self, model_name=RERANK_MODEL, max_batch_size=RERANK_MAX_BATCH,
+                 max_wait_ms=RERANK_MAX_WAIT_MS, num_threads=RERANK_THREADS):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.num_threads = num_threads
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def load(self):
+        with self._model_lock:
+            if self._model is None:
+                import torch
+                from sentence_transformers import CrossEncoder
+
+                if self.num_threads > 0:
+                    torch.set_num_threads(self.num_threads)
+                print(f"loading reranker {self.model_name}")
+                self._model = CrossEncoder(self.model_name, max_length=512)
+            return self._model
+
+    def predict(self, pairs):
+        if len(pairs) == 0:
+            return []
+        future = Future()
+        self._requests.put((pairs, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                model = self.load()
+                scores = model.predict(
+                    [pair for pairs, _ in batch for pair in pairs],
+                    batch_size=max(self.max_batch_size, 1),
+                    show_progress_bar=False,
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for pairs, future in batch:
+                future.set_result([float(score) for score in scores[start:start + len(pairs)]])
+                start += len(pairs)
+
+
+_cross_encoder = None
+_cross_encoder_lock = threading.Lock()
+
+
+def get_shared_cross_encoder():
+    global _cross_encoder
+    with _cross_encoder_lock:
+        if _cross_encoder is None:
+            _cross_encoder = BatchingCrossEncoder()
+        return _cross_encoder
+
+
+class SharedSentenceTransformerRerank(BaseNodePostprocessor):
+    # same scoring as SentenceTransformerRerank, but every instance shares the
+    # process-wide batching cross-encoder instead of loading its own copy
+
+    top_n: int = Field(description="Number of nodes to return sorted by score.")
+    course_code: str = Field(default="", description="Course label for metrics.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SharedSentenceTransformerRerank"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+        pairs = [
+            (query_bundle.query_str, node.node.get_content(metadata_mode=MetadataMode.EMBED))
+            for node in nodes
+        ]
+        with span("rerank", course=self.course_code):
+            scores = get_shared_cross_encoder().predict(pairs)
+        for node, score in zip(nodes, scores):
+            node.score = score
+        return sorted(nodes, key=lambda x: -x.score if x.score else 0)[: self.top_n]
@@ -0,0 +1,214 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from llama_index.llms import ChatMessage, MessageRole
+from llama_index.schema import MetadataMode, QueryBundle
+
+from metrics import metrics, span
+from context_budget import TurnBudget
+
+
+ROUTER_ENABLED = os.getenv("TUTOR_ROUTER", "1") == "1"
+# a question goes straight to the best tool when it scores at least this and
+# beats every other tool by the margin, otherwise the agent chooses. a high
+# score alone is not enough: generic questions score high on every tool.
+ROUTER_MIN_SCORE = float(os.getenv("TUTOR_ROUTER_MIN_SCORE", "0.80"))
+ROUTER_MARGIN = float(os.getenv("TUTOR_ROUTER_MARGIN", "0.05"))
+ROUTER_MAX_EXEMPLARS = int(os.getenv("TUTOR_ROUTER_MAX_EXEMPLARS", "64"))
+
+DEFAULT_EXEMPLARS = {
+    "lecture_question_query_engine": [
+        "Can you explain this concept from the lecture?",
+        "What is the definition of this term?",
+        "How does this algorithm work?",
+        "What did the slides say about this topic?",
+        "Give me an example of this idea from class.",
+    ],
+    "practice_question_query_engine": [
+        "How do I solve this homework problem?",
+        "Can you give me a hint for the assignment question?",
+        "What is the approach for this practice problem?",
+        "I am stuck on question 2 of the homework.",
+        "Can you walk me through a similar exercise?",
+    ],
+    "syllabus_question_query_engine": [
+        "When is the homework due?",
+        "When is the midterm exam?",
+        "What is the grading policy of this course?",
+        "What are the office hours?",
+        "Is there a late submission policy?",
+    ],
+}
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+class ToolRouter:
+    # picks query engine tools for a question by cosine similarity against
+    # each tool's description and example questions. questions the agent
+    # routed itself become new examples, so the router gets more confident
+    # for the kinds of questions a course actually sees.
+
+    def __init__(self, tools, embed_model, exemplars=None, min_score=ROUTER_MIN_SCORE,
+                 margin=ROUTER_MARGIN, max_exemplars=ROUTER_MAX_EXEMPLARS):
+        self.embed_model = embed_model
+        self.min_score = min_score
+        self.margin = margin
+        self.max_exemplars = max_exemplars
+        self._lock = threading.Lock()
+        self._vectors = {}
+        self._fixed = {}
+        exemplars = exemplars or {}
+        for tool in tools:
+            name = tool.metadata.name
+            texts = [tool.metadata.description] + DEFAULT_EXEMPLARS.get(name, []) + exemplars.get(name, [])
+            self._vectors[name] = normalize(embed_model.get_text_embedding_batch(texts))
+            self._fixed[name] = len(texts)
+
+    def scores(self, embedding):
+        query = normalize(embedding)
+        with self._lock:
+            return {name: float(np.max(vectors @ query)) for name, vectors in self._vectors.items()}
+
+    def route(self, embedding):
+        # tool names to query, or None when the agent should choose
+        scores = sorted(self.scores(embedding).items(), key=lambda item: -item[1])
+        if len(scores) == 0 or scores[0][1] < self.min_score:
+            return None
+        if len(scores) > 1 and scores[0][1] - scores[1][1] < self.margin:
+            return None
+        return [scores[0][0]]
+
+    def add_exemplar(self, tool_name, embedding):
+        with self._lock:
+            vectors = self._vectors.get(tool_name)
+            if vectors is None:
+                return
+            vectors = np.vstack([vectors, normalize([embedding])])
+            # the description and the configured examples are always kept
+            keep = self._fixed[tool_name]
+            if len(vectors) > keep + self.max_exemplars:
+                vectors = np.vstack([vectors[:keep], vectors[-self.max_exemplars:]])
+            self._vectors[tool_name] = vectors
+
+
+class RoutedResponse:
+    # the parts of StreamingAgentChatResponse the callers use. the turn is
+    # written to the agent memory once the stream is exhausted.
+
+    def __init__(self, chat_stream, source_nodes, on_done):
+        self.source_nodes = source_nodes
+        self.sources = []
+        self.response = ""
+        self._chat_stream = chat_stream
+        self._on_done = on_done
+
+    @property
+    def response_gen(self):
+        for chunk in self._chat_stream:
+            self.response += chunk.delta or ""
+            yield chunk.delta or ""
+        self._on_done(self.response)
+
+    def __str__(self):
+        return self.response
+
+
+class RoutedAgent:
+    # answers with one llm call over the routed tools' retrieved nodes when
+    # the router is confident, and hands the turn to the function calling
+    # agent otherwise, or always when there is no router. both share the
+    # same chat memory, and every turn gets one context token budget.
+
+    def __init__(self, agent, tools, router, llm, system_prompt, course_code=""):
+        self._agent = agent
+        self._router = router
+        self._llm = llm
+        self._system_prompt = system_prompt
+        self._course_code = course_code
+        self._tools = {tool.metadata.name: tool for tool in tools}
+        self.last_tokens_saved = 0
+
+    @property
+    def memory(self):
+        return self._agent.memory
+
+    @property
+    def chat_history(self):
+        return self._agent.chat_history
+
+    def reset(self):
+        self._agent.reset()
+
+    def _route(self, message):
+        if self._router is None:
+            return None, None
+        with span("route", course=self._course_code):
+            embedding = self._router.embed_model.get_query_embedding(message)
+            tool_names = self._router.route(embedding)
+        metrics.incr("router", outcome="direct" if tool_names else "agent", course=self._course_code)
+        return embedding, tool_names
+
+    def _retrieve(self, tool_names, message, turn):
+        query_bundle = QueryBundle(message)
+
+        def retrieve(name):
+            # the worker threads spend the same turn budget
+            with turn.activate():
+                return self._tools[name].query_engine.retrieve(query_bundle)
+
+        with span("routed_retrieve", course=self._course_code):
+            if len(tool_names) == 1:
+                return [retrieve(tool_names[0])]
+            with ThreadPoolExecutor(max_workers=len(tool_names)) as executor:
+                return list(executor.map(retrieve, tool_names))
+
+    def _learn(self, resp, embedding):
+        if self._router is None:
+            return
+        tool_names = {source.tool_name for source in resp.sources}
+        if len(tool_names) == 1:
+            self._router.add_exemplar(tool_names.pop(), embedding)
+
+    def _remember(self, message, answer):
+        self.memory.put(ChatMessage(role=MessageRole.USER, content=message))
+        self.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+
+    def stream_chat(self, message):
+        turn = TurnBudget(self._course_code)
+        with turn.activate():
+            resp = self._stream_chat(message, turn)
+        self.last_tokens_saved = turn.saved
+        print(f"{self._course_code}: {turn.saved} prompt tokens saved")
+        return resp
+
+    def _stream_chat(self, message, turn):
+        embedding, tool_names = self._route(message)
+        if tool_names is None:
+            resp = self._agent.stream_chat(message)
+            self._learn(resp, embedding)
+            return resp
+        results = self._retrieve(tool_names, message, turn)
+        source_nodes = [node for nodes in results for node in nodes]
+        context = "\n\n".join(
+            f"[{name}]\n" + "\n\n".join(n.node.get_content(metadata_mode=MetadataMode.LLM) for n in nodes)
+            for name, nodes in zip(tool_names, results))
+        messages = [ChatMessage(role=MessageRole.SYSTEM, content=self._system_prompt)]
+        messages += self.memory.get()
+        messages.append(ChatMessage(
+            role=MessageRole.USER,
+            content=f"Course material:\n{context}\n\nUsing the course material above, answer: {message}"))
+        return RoutedResponse(self._llm.stream_chat(messages), source_nodes,
+                              on_done=lambda answer: self._remember(message, answer))
+
+    def chat(self, message):
+        resp = self.stream_chat(message)
+        for _ in resp.response_gen:
+            pass
+        return resp
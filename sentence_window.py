@@ -0,0 +1,155 @@
+import os
+import json
+from typing import List, Optional, Sequence
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.indices.postprocessor import MetadataReplacementPostProcessor
+from llama_index.node_parser import SentenceWindowNodeParser
+from llama_index.schema import BaseNode, Document, NodeWithScore, QueryBundle
+
+from metrics import span
+from lexical_index import LexicalIndex
+
+
+SENTENCE_BUFFER_FILE = "sentence_buffer.json"
+WINDOW_START_KEY = "window_start"
+WINDOW_END_KEY = "window_end"
+
+
+class SentenceBuffer:
+    # every sentence of a document stored once, back to back in one string,
+    # with the offset where each sentence starts. a window is then just a
+    # (start, end) range of sentence numbers instead of a copy of its text.
+
+    def __init__(self, docs=None):
+        self._docs = docs or {}
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir):
+        path = os.path.join(persist_dir, SENTENCE_BUFFER_FILE)
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def persist(self, persist_dir):
+        path = os.path.join(persist_dir, SENTENCE_BUFFER_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self._docs, f)
+        os.replace(path + ".tmp", path)
+
+    def add(self, ref_doc_id, sentences):
+        offsets = [0]
+        for sentence in sentences:
+            offsets.append(offsets[-1] + len(sentence))
+        self._docs[ref_doc_id] = {"text": "".join(sentences), "offsets": offsets}
+
+    def delete(self, ref_doc_id):
+        self._docs.pop(ref_doc_id, None)
+
+    def update(self, other):
+        # the documents of another buffer, e.g. one course of the unified index
+        self._docs.update(other._docs)
+
+    def sentences(self, ref_doc_id, start, end):
+        doc = self._docs[ref_doc_id]
+        offsets = doc["offsets"]
+        return [doc["text"][offsets[i]:offsets[i + 1]] for i in range(start, end)]
+
+    def window(self, ref_doc_id, start, end):
+        # joined exactly like SentenceWindowNodeParser joins its windows
+        return " ".join(self.sentences(ref_doc_id, start, end))
+
+
+class CompactSentenceWindowNodeParser(SentenceWindowNodeParser):
+    # same nodes as SentenceWindowNodeParser, but the window and original
+    # text metadata are replaced by sentence ranges into a SentenceBuffer.
+    # it also carries the lexical index of the same index, which nodes are
+    # added to as they are inserted.
+
+    _sentence_buffer: SentenceBuffer = PrivateAttr()
+    _lexical_index: LexicalIndex = PrivateAttr()
+
+    def __init__(self, *args, sentence_buffer=None, lexical_index=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sentence_buffer = sentence_buffer or SentenceBuffer()
+        self._lexical_index = lexical_index if lexical_index is not None else LexicalIndex()
+
+    @classmethod
+    def from_defaults(cls, sentence_buffer=None, lexical_index=None, **kwargs):
+        parser = super().from_defaults(**kwargs)
+        parser._sentence_buffer = sentence_buffer or SentenceBuffer()
+        parser._lexical_index = lexical_index if lexical_index is not None else LexicalIndex()
+        return parser
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CompactSentenceWindowNodeParser"
+
+    @property
+    def sentence_buffer(self):
+        return self._sentence_buffer
+
+    @property
+    def lexical_index(self):
+        return self._lexical_index
+
+    def build_window_nodes_from_documents(self, documents: Sequence[Document]) -> List[BaseNode]:
+        nodes = super().build_window_nodes_from_documents(documents)
+        doc_nodes = {}
+        for node in nodes:
+            doc_nodes.setdefault(node.ref_doc_id, []).append(node)
+        for ref_doc_id, sentence_nodes in doc_nodes.items():
+            self._sentence_buffer.add(ref_doc_id, [n.text for n in sentence_nodes])
+            for i, node in enumerate(sentence_nodes):
+                start = max(0, i - self.window_size)
+                end = min(i + self.window_size, len(sentence_nodes))
+                window = node.metadata[self.window_metadata_key]
+                if self._sentence_buffer.window(ref_doc_id, start, end) != window:
+                    # keep the full window if it cannot be rebuilt exactly
+                    continue
+                del node.metadata[self.window_metadata_key]
+                node.metadata.pop(self.original_text_metadata_key, None)
+                node.metadata[WINDOW_START_KEY] = start
+                node.metadata[WINDOW_END_KEY] = end
+                node.excluded_embed_metadata_keys.extend([WINDOW_START_KEY, WINDOW_END_KEY])
+                node.excluded_llm_metadata_keys.extend([WINDOW_START_KEY, WINDOW_END_KEY])
+        return nodes
+
+
+class WindowReplacementPostProcessor(MetadataReplacementPostProcessor):
+    # rebuilds the window of compact nodes from the sentence buffer, only for
+    # the nodes that were actually retrieved. nodes that still carry the full
+    # window in their metadata are handled as before.
+
+    _sentence_buffer: SentenceBuffer = PrivateAttr()
+    _course_code: str = PrivateAttr()
+
+    def __init__(self, sentence_buffer, target_metadata_key="window", course_code="", **kwargs):
+        super().__init__(target_metadata_key=target_metadata_key, **kwargs)
+        self._sentence_buffer = sentence_buffer
+        self._course_code = course_code
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "WindowReplacementPostProcessor"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        with span("metadata_replacement", course=self._course_code):
+            for n in nodes:
+                metadata = n.node.metadata
+                if self.target_metadata_key not in metadata and WINDOW_START_KEY in metadata:
+                    try:
+                        n.node.set_content(self._sentence_buffer.window(
+                            n.node.ref_doc_id, metadata[WINDOW_START_KEY], metadata[WINDOW_END_KEY]))
+                    except KeyError:
+                        # the document was removed since it was retrieved,
+                        # the node keeps its own sentence
+                        continue
+                else:
+                    n.node.set_content(metadata.get(self.target_metadata_key, n.node.get_content()))
+        return nodes
@@ -0,0 +1,291 @@
+import os
+import json
+import uuid
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import List
+
+import numpy as np
+from llama_index.constants import DATA_KEY
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.indices.utils import embed_nodes
+from llama_index.llms import OpenAI
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.vector_stores.types import ExactMatchFilter, MetadataFilters
+
+from metrics import span
+from model import (
+    PARSE_WORKERS,
+    VECTOR_STORE_TYPE,
+    build_sentence_window_index,
+    document_id,
+    file_hash,
+    get_embed_model,
+    load_file_documents,
+    sentence_window_parser,
+)
+from sentence_window import SentenceBuffer
+
+
+# per_course keeps one index directory per course category, unified keeps
+# every course in one index and filters on course_code and category
+INDEX_LAYOUT = os.getenv("TUTOR_INDEX_LAYOUT", "per_course")
+UNIFIED_INDEX_DIR = os.getenv("TUTOR_UNIFIED_INDEX_DIR", os.path.join("db", "unified_index"))
+SHARDS_DIR = "shards"
+SHARD_NODES_FILE = "nodes.json"
+SHARD_VECTORS_FILE = "vectors.npy"
+
+
+def manifest_key(course_code, category):
+    return f"{course_code}/{category}"
+
+
+class ReadWriteLock:
+    # any number of readers or one writer. a waiting writer blocks new readers
+    # so a steady stream of queries cannot starve the ingest worker.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class LockedRetriever(BaseRetriever):
+    # a search of the unified index sees a course either before or after a
+    # sync, never halfway: changes are applied under the write lock
+
+    def __init__(self, retriever, lock):
+        super().__init__(callback_manager=retriever.callback_manager)
+        self._retriever = retriever
+        self._lock = lock
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with self._lock.read():
+            return self._retriever.retrieve(query_bundle)
+
+
+class UnifiedIndex:
+    # one index for every course, each node tagged with its course_code and
+    # category. on disk every course category is a shard of its own: nodes,
+    # vectors and sentence buffer in a directory per generation, and a small
+    # pointer file naming the live generation. a sync parses and embeds into
+    # a new shard directory, switches the pointer, then swaps the course's
+    # nodes in the loaded index. a process loads a course's shards the first
+    # time the course is used, and after that reloads a shard only when its
+    # pointer changed, so adding a course never rewrites or reloads the others.
+
+    def __init__(self, save_dir=UNIFIED_INDEX_DIR, vector_store_type=VECTOR_STORE_TYPE):
+        self.save_dir = save_dir
+        self.vector_store_type = vector_store_type
+        self._index = None
+        # key -> (generation, ref doc ids) of the shards in the loaded index
+        self._shards = {}
+        self._rw = ReadWriteLock()
+        # loads run one at a time, syncs only take it to switch a shard
+        self._load_lock = threading.Lock()
+
+    def _shard_path(self, course_code, category):
+        return os.path.join(self.save_dir, SHARDS_DIR, f"{course_code}_{category}")
+
+    def _read_pointer(self, shard_path):
+        path = shard_path + ".json"
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_pointer(self, shard_path, pointer):
+        path = shard_path + ".json"
+        with open(path + ".tmp", "w") as f:
+            json.dump(pointer, f)
+        os.replace(path + ".tmp", path)
+
+    def _read_shard(self, shard_path, generation):
+        shard_dir = f"{shard_path}-{generation}"
+        with open(os.path.join(shard_dir, SHARD_NODES_FILE)) as f:
+            nodes = [json_to_doc(data) for data in json.load(f)]
+        vectors = np.load(os.path.join(shard_dir, SHARD_VECTORS_FILE))
+        for node, vector in zip(nodes, vectors):
+            node.embedding = vector.tolist()
+        return nodes, SentenceBuffer.from_persist_dir(shard_dir)
+
+    def _write_shard(self, shard_path, generation, nodes, sentence_buffer):
+        shard_dir = f"{shard_path}-{generation}"
+        os.makedirs(shard_dir)
+        data = []
+        for node in nodes:
+            # the vectors go to a binary file of their own
+            node_data = doc_to_json(node)
+            node_data[DATA_KEY]["embedding"] = None
+            data.append(node_data)
+        with open(os.path.join(shard_dir, SHARD_NODES_FILE), "w") as f:
+            json.dump(data, f)
+        np.save(os.path.join(shard_dir, SHARD_VECTORS_FILE),
+                np.array([node.embedding for node in nodes], dtype=np.float32))
+        sentence_buffer.persist(shard_dir)
+
+    def ready(self, course_code, category):
+        # read from disk, so courses ingested by another process count too
+        return os.path.exists(self._shard_path(course_code, category) + ".json")
+
+    def filters(self, course_code, category):
+        return MetadataFilters(filters=[
+            ExactMatchFilter(key="course_code", value=course_code),
+            ExactMatchFilter(key="category", value=category),
+        ])
+
+    def locked_retriever(self, retriever):
+        return LockedRetriever(retriever, self._rw)
+
+    def get(self, course_code, category):
+        # the index with this course category loaded as it is on disk now
+        with self._load_lock:
+            if self._index is None:
+                # the vectors are in the shards, the index itself is only in memory
+                self._index = build_sentence_window_index(
+                    [],
+                    llm=OpenAI(model="gpt-4", temperature=0.2),
+                    save_dir=None,
+                    embed_model=get_embed_model(),
+                    vector_store_type=self.vector_store_type,
+                )
+            self._load(course_code, category)
+            return self._index
+
+    def _load(self, course_code, category):
+        key = manifest_key(course_code, category)
+        shard_path = self._shard_path(course_code, category)
+        pointer = self._read_pointer(shard_path)
+        if pointer is None:
+            if key in self._shards:
+                with self._rw.write():
+                    self._apply(key, None, [], SentenceBuffer())
+            return
+        if self._shards.get(key, (None,))[0] == pointer["generation"]:
+            return
+        try:
+            with span("index_load", index=os.path.basename(shard_path)):
+                nodes, sentence_buffer = self._read_shard(shard_path, pointer["generation"])
+        except FileNotFoundError:
+            # replaced by another process while reading, taken on the next get
+            return
+        with self._rw.write():
+            self._apply(key, pointer["generation"], nodes, sentence_buffer)
+
+    def _apply(self, key, generation, nodes, sentence_buffer):
+        # swaps the nodes of one shard in the loaded index, under the write lock
+        node_parser = self._index.service_context.node_parser
+        _, ref_doc_ids = self._shards.get(key, (None, []))
+        if generation is not None:
+            # until the swap is done the shard has no generation, so a swap
+            # that failed halfway is done again, deleting whatever it added
+            ref_doc_ids = sorted(set(ref_doc_ids) | {node.ref_doc_id for node in nodes})
+            self._shards[key] = (None, ref_doc_ids)
+        for ref_doc_id in ref_doc_ids:
+            self._index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+            node_parser.sentence_buffer.delete(ref_doc_id)
+            node_parser.lexical_index.delete(ref_doc_id)
+        if generation is None:
+            self._shards.pop(key, None)
+            return
+        # embeddings are set, inserting does not call the embedding model
+        self._index.insert_nodes(nodes)
+        node_parser.sentence_buffer.update(sentence_buffer)
+        node_parser.lexical_index.add(nodes)
+        self._shards[key] = (generation, sorted({node.ref_doc_id for node in nodes}))
+
+    def sync(self, course_code, category, input_files, parse_workers=PARSE_WORKERS, progress=None):
+        # progress(input_file, stage) as in model.sync_index. until the pointer
+        # is switched nothing but the new shard directory is written, and the
+        # loaded index is only touched after that
+        key = manifest_key(course_code, category)
+        tags = {"course_code": course_code, "category": category}
+        report = progress or (lambda input_file, stage: None)
+        shard_path = self._shard_path(course_code, category)
+        generation, switched = uuid.uuid4().hex, False
+        try:
+            pointer = self._read_pointer(shard_path)
+            manifest = pointer["files"] if pointer is not None else {}
+            current = {input_file: file_hash(input_file) for input_file in input_files}
+            removed = [f for f in manifest if current.get(f) != manifest[f]]
+            added = [f for f in current if manifest.get(f) != current[f]]
+            if pointer is not None and not removed and not added:
+                return
+            if pointer is not None:
+                nodes, sentence_buffer = self._read_shard(shard_path, pointer["generation"])
+            else:
+                nodes, sentence_buffer = [], SentenceBuffer()
+            removed_ids = {document_id(f, tags) for f in removed}
+            for input_file in removed:
+                print(f"removing {input_file} from {shard_path}")
+                sentence_buffer.delete(document_id(input_file, tags))
+            nodes = [node for node in nodes if node.ref_doc_id not in removed_ids]
+            # parsed into the copy of the shard's sentence buffer read above
+            node_parser = sentence_window_parser(sentence_buffer)
+            embed_model = get_embed_model()
+            for input_file, document in load_file_documents(added, parse_workers, tags, current):
+                print(f"adding {input_file} to {shard_path}")
+                report(input_file, "parsed")
+                with span("node_parse"):
+                    file_nodes = node_parser.get_nodes_from_documents([document])
+                report(input_file, "chunked")
+                embeddings = embed_nodes(file_nodes, embed_model)
+                for node in file_nodes:
+                    node.embedding = embeddings[node.node_id]
+                nodes.extend(file_nodes)
+                report(input_file, "embedded")
+            os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+            self._write_shard(shard_path, generation, nodes, sentence_buffer)
+            for input_file in added:
+                report(input_file, "persisted")
+            with self._load_lock:
+                self._write_pointer(shard_path, {"course_code": course_code, "category": category,
+                                                 "files": current, "generation": generation})
+                switched = True
+                if self._index is not None:
+                    with self._rw.write():
+                        self._apply(key, generation, nodes, sentence_buffer)
+        except BaseException:
+            if not switched:
+                shutil.rmtree(f"{shard_path}-{generation}", ignore_errors=True)
+            # pooled tools of the course are loaded again from what is live
+            from agent_pool import course_pool
+            course_pool.invalidate(course_code)
+            raise
+        if pointer is not None:
+            shutil.rmtree(f"{shard_path}-{pointer['generation']}", ignore_errors=True)
+
+
+unified_index = UnifiedIndex()
@@ -0,0 +1,99 @@
+import os
+import time
+import importlib
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from agent_pool import course_pool
+from dao import find_course_config, get_index_version, get_recent_course_codes
+from metrics import metrics, span
+
+
+# off by default, a server that starts warm loads the reranker and the hot
+# courses' indexes in the background so the first questions do not wait on them
+WARMUP_ENABLED = os.getenv("TUTOR_WARMUP", "0") == "1"
+# comma separated course codes, otherwise the courses with the latest messages
+WARMUP_COURSES = [c.strip() for c in os.getenv("TUTOR_WARMUP_COURSES", "").split(",") if c.strip()]
+WARMUP_TOP_COURSES = int(os.getenv("TUTOR_WARMUP_TOP_COURSES", "3"))
+WARMUP_ACTIVE_DAYS = float(os.getenv("TUTOR_WARMUP_ACTIVE_DAYS", "14"))
+
+_lock = threading.Lock()
+_started = False
+_cold_start_reported = False
+_first_answer_reported = False
+_warm_courses = set()
+
+
+def hot_courses(messages_collection):
+    if WARMUP_COURSES:
+        return WARMUP_COURSES
+    since = datetime.utcnow() - timedelta(days=WARMUP_ACTIVE_DAYS)
+    return get_recent_course_codes(messages_collection, WARMUP_TOP_COURSES, since)
+
+
+def warm_course(course_code, course_config):
+    import course_service
+
+    course_pool.get(course_code, get_index_version(course_config),
+                    lambda: course_service.load_course_tools(course_code, course_config))
+
+
+def _warm_up(courses_collection, messages_collection):
+    start = time.perf_counter()
+    with span("warmup", part="import"):
+        # llama_index and the index code, which the app imports lazily. the
+        # import itself is the warm-up, nothing from model is used here
+        importlib.import_module("model")
+        from rerank import get_shared_cross_encoder
+    with span("warmup", part="reranker"):
+        get_shared_cross_encoder().load()
+    for course_code in hot_courses(messages_collection):
+        course_config = find_course_config(courses_collection, course_code)
+        if course_config is None:
+            continue
+        try:
+            with span("warmup", part="course", course=course_code):
+                warm_course(course_code, course_config)
+        except Exception:
+            # the course loads again on its first question
+            traceback.print_exc()
+            continue
+        with _lock:
+            _warm_courses.add(course_code)
+    print(f"warm-up done in {time.perf_counter() - start:.2f}s, courses: {sorted(_warm_courses)}")
+
+
+def start_warmup(courses_collection, messages_collection):
+    # once per process, in a daemon thread so serving starts right away
+    global _started
+    with _lock:
+        if not WARMUP_ENABLED or _started:
+            return
+        _started = True
+    threading.Thread(target=_warm_up, args=(courses_collection, messages_collection),
+                     daemon=True, name="tutor-warmup").start()
+
+
+def report_cold_start(seconds):
+    # time from the process importing the app to serving its first request
+    global _cold_start_reported
+    with _lock:
+        if _cold_start_reported:
+            return
+        _cold_start_reported = True
+    metrics.observe("cold_start", seconds, warmup="on" if WARMUP_ENABLED else "off")
+    print(f"cold start {seconds:.2f}s")
+
+
+def report_first_answer(seconds, course_code):
+    # first token of the first answer this process gave, warm when its
+    # course had been preloaded
+    global _first_answer_reported
+    with _lock:
+        if _first_answer_reported:
+            return
+        _first_answer_reported = True
+        warm = course_code in _warm_courses
+    metrics.observe("first_answer", seconds, course=course_code, warm="yes" if warm else "no")
+    print(f"{course_code}: first answer since start {seconds:.2f}s ({'warm' if warm else 'cold'})")